@@ -0,0 +1,158 @@
+"""Measures latency percentiles and SQL query counts of the hot endpoints against the configured database.
+
+Fill the database first, e.g. with lorryserver.db.init_synthetic_data. The requests are issued in-process
+through Flask's test client, so the numbers do not include the WSGI server or the network.
+
+Usage: python3 -m benchmarks.endpoints [--iterations N] [--output results.json] [--compare previous.json]
+"""
+import argparse
+import datetime
+import io
+import json
+import random
+import statistics
+import subprocess
+import time
+import uuid
+
+import sqlalchemy
+
+def get_git_commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "HEAD"], check=True, capture_output=True, text=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def get_percentile(sorted_values, percentile):
+	index = min(len(sorted_values) - 1, int(round(percentile / 100.0 * (len(sorted_values) - 1))))
+	return sorted_values[index]
+
+class QueryCounter():
+	def __init__(self):
+		self.n_queries = 0
+
+	def on_query(self, *args, **kwargs):
+		self.n_queries += 1
+
+def get_benchmark_requests(models, rng):
+	"""Returns the benchmarked endpoints as (name, needs_login, function that returns the request arguments).
+	"""
+	package_ids = [package_id.hex for (package_id,) in models.db.session.query(models.Package.id).all()]
+	file_ids = [file_id.hex for (file_id,) in models.db.session.query(models.Resource.id).all()]
+	tags = [title for (title,) in models.db.session.query(models.Tag.title).all() if not title.startswith(".")]
+	if not package_ids or not file_ids or not tags:
+		raise ValueError("The benchmarks need a database with packages, files and tags.")
+
+	# Package edits alternate between two descriptions, so that every request changes the package.
+	edited_package = models.Package.query.get(uuid.UUID(rng.choice(package_ids)))
+	edit_data = dict(title=edited_package.title, author=edited_package.author or "", long_description=edited_package.long_description or "",
+					tags=json.dumps([dict(value=t.title) for t in edited_package.tags if t.title[0] != "."]),
+					dependencies=edited_package.get_dependency_string())
+	edit_counter = [0]
+
+	def get_edit_request():
+		edit_counter[0] += 1
+		data = dict(edit_data, description="Benchmark edit number {} with enough characters for the minimum length.".format(edit_counter[0] % 2),
+					files=(io.BytesIO(b"benchmark"), "benchmark.ocd"))
+		return dict(path="/upload/" + edited_package.id.hex, method="POST", data=data, content_type="multipart/form-data")
+
+	return [
+		("index", False, lambda: dict(path="/")),
+		("index_tag_filter", False, lambda: dict(path="/", query_string=dict(tags=rng.choice(tags)))),
+		("api_uploads", False, lambda: dict(path="/api/uploads")),
+		("api_uploads_search", False, lambda: dict(path="/api/uploads", query_string=dict(q=rng.choice(tags).split("-")[-1]))),
+		("api_upload_details", False, lambda: dict(path="/api/uploads/" + rng.choice(package_ids))),
+		("api_upload_details_batch", False, lambda: dict(path="/api/uploads/batch", method="POST", data=dict(ids=",".join(rng.sample(package_ids, min(50, len(package_ids))))))),
+		("api_files", False, lambda: dict(path="/api/files/" + rng.choice(file_ids))),
+		("package_details", False, lambda: dict(path="/uploads/" + rng.choice(package_ids))),
+		("fetch_tag_suggestion", True, lambda: dict(path="/fetch_tag_suggestion", query_string=dict(tag=rng.choice(tags)[:4]))),
+		("upload_form", True, lambda: dict(path="/upload")),
+		("upload_edit", True, get_edit_request),
+	], edited_package.owner
+
+def run_benchmarks(iterations=200, warmup=20, seed=0):
+	from lorryserver.core import create_flask_application
+	from lorryserver.db import models
+
+	app = create_flask_application()
+	app.config["WTF_CSRF_ENABLED"] = False
+	# The benchmark client would quickly run out of tokens.
+	app.config["ADMISSION_CONTROL_ENABLED"] = False
+	rng = random.Random(seed)
+	counter = QueryCounter()
+
+	with app.app_context():
+		sqlalchemy.event.listen(models.db.engine, "before_cursor_execute", counter.on_query)
+		benchmark_requests, user_id = get_benchmark_requests(models, rng)
+		n_packages = models.Package.query.count()
+
+	client = app.test_client()
+	with client.session_transaction() as session:
+		session["_user_id"] = str(user_id)
+		session["_fresh"] = True
+	anonymous_client = app.test_client()
+
+	results = dict()
+	for (name, needs_login, get_request) in benchmark_requests:
+		current_client = client if needs_login else anonymous_client
+		durations, query_counts = [], []
+		for iteration in range(warmup + iterations):
+			request = get_request()
+			counter.n_queries = 0
+			start = time.perf_counter()
+			response = current_client.open(**request)
+			response.get_data()
+			duration = time.perf_counter() - start
+			response.close()
+			if response.status_code >= 400:
+				raise RuntimeError("{} returned status {}.".format(name, response.status_code))
+			if iteration >= warmup:
+				durations.append(duration * 1000.0)
+				query_counts.append(counter.n_queries)
+
+		durations.sort()
+		results[name] = dict(
+			p50_ms=get_percentile(durations, 50),
+			p90_ms=get_percentile(durations, 90),
+			p99_ms=get_percentile(durations, 99),
+			mean_ms=statistics.mean(durations),
+			mean_queries=statistics.mean(query_counts),
+			max_queries=max(query_counts),
+		)
+		print("{:<24} p50 {:8.2f}ms  p90 {:8.2f}ms  p99 {:8.2f}ms  queries {:6.1f}".format(name, results[name]["p50_ms"], results[name]["p90_ms"],
+																						results[name]["p99_ms"], results[name]["mean_queries"]), flush=True)
+
+	return dict(
+		commit=get_git_commit(),
+		date=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+		iterations=iterations,
+		n_packages=n_packages,
+		results=results,
+	)
+
+def print_comparison(previous, current):
+	print("Compared to commit {}:".format(previous.get("commit")))
+	for name, result in current["results"].items():
+		if name not in previous["results"]:
+			continue
+		old_result = previous["results"][name]
+		print("{:<24} p50 {:+7.1f}%  p99 {:+7.1f}%  queries {:+6.1f}".format(name,
+			100.0 * (result["p50_ms"] / old_result["p50_ms"] - 1.0), 100.0 * (result["p99_ms"] / old_result["p99_ms"] - 1.0),
+			result["mean_queries"] - old_result["mean_queries"]))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--iterations", type=int, default=200)
+	parser.add_argument("--warmup", type=int, default=20)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--output", help="Where to save the results as JSON.")
+	parser.add_argument("--compare", help="Results of an earlier run to compare against.")
+	args = parser.parse_args()
+
+	current = run_benchmarks(args.iterations, args.warmup, args.seed)
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(current, f, indent=2)
+	if args.compare:
+		with open(args.compare) as f:
+			print_comparison(json.load(f), current)
@@ -0,0 +1,39 @@
+"""Measures how long a fresh worker process needs to import lorryserver and create the application,
+and how much memory it holds afterwards.
+
+Usage: python3 -m benchmarks.startup_time [number of runs]
+"""
+import json
+import pathlib
+import statistics
+import subprocess
+import sys
+
+MEASUREMENT_SCRIPT = """
+import json, resource, time
+start = time.perf_counter()
+from lorryserver.wsgi import app
+duration = time.perf_counter() - start
+print(json.dumps(dict(seconds=duration, max_rss_kib=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)))
+"""
+
+def measure_startup(n_runs=10):
+	repository_root = pathlib.Path(__file__).resolve().parent.parent
+	results = []
+	for _ in range(n_runs):
+		output = subprocess.run([sys.executable, "-c", MEASUREMENT_SCRIPT], cwd=repository_root,
+								check=True, capture_output=True, text=True).stdout
+		results.append(json.loads(output.strip().splitlines()[-1]))
+
+	durations = [r["seconds"] for r in results]
+	return dict(
+		runs=n_runs,
+		median_seconds=statistics.median(durations),
+		min_seconds=min(durations),
+		max_seconds=max(durations),
+		median_max_rss_kib=statistics.median((r["max_rss_kib"] for r in results)),
+	)
+
+if __name__ == "__main__":
+	n_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+	print(json.dumps(measure_startup(n_runs), indent=2))
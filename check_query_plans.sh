@@ -0,0 +1 @@
+python3 -c "import sys;from lorryserver.db.check_query_plans import check_query_plans;sys.exit(0 if check_query_plans() else 1)"
@@ -0,0 +1 @@
+python3 -c "from lorryserver.jobs import compress_all_resources;compress_all_resources()"
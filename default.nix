@@ -64,11 +64,14 @@ python3Packages.buildPythonPackage {
     email-validator
     flask-wtf
     flask-markdown
+    markdown
     flask-caching
     is-safe-url
     passlib
     dicttoxml
     python-slugify
+    zstandard
+    bsdiff4
   ];
 
   meta = {
@@ -0,0 +1 @@
+python3 -c "from lorryserver.jobs import index_all_resources;index_all_resources()"
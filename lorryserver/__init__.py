@@ -1 +1 @@
-from .app import app
+from .core import create_flask_application as create_app
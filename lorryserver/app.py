@@ -4,30 +4,36 @@ from flask import render_template
 from wtforms.validators import ValidationError
 import datetime
 import flask_wtf.csrf
-import flaskext.markdown
 import flask_caching
 import hmac
 import jinja2
 import dicttoxml
 import slugify
+import sqlalchemy.orm
 import urllib
 import json
 import math
+import time
 import uuid
 import werkzeug.utils
 
 from is_safe_url import is_safe_url
 import flask_login
 
-from . import core
 from . import forms
+from . import jobs
+from .core import cache, login_manager
 from .utils import passwords, resources
-from .db import models
+from .utils.admission import admission_controlled
+from .utils.metrics import metrics
+from .db import models, catalog, replicas
 
-app = core.create_flask_application()
-flaskext.markdown.Markdown(app)
-cache = flask_caching.Cache(app)
-login_manager = core.get_login_manager()
+blueprint = flask.Blueprint("lorry", __name__)
+
+@blueprint.record_once
+def init_catalog_read_model(state):
+	if state.app.config.get("CATALOG_READ_MODEL"):
+		state.app.extensions["catalog_read_model"] = catalog.CatalogReadModel(max_age=state.app.config.get("CATALOG_READ_MODEL_MAX_AGE"))
 
 # Is enabled by default.
 # csrf = flask_wtf.csrf.CSRFProtect(app=app)
@@ -35,53 +41,91 @@ login_manager = core.get_login_manager()
 def dict_to_xml(dictionary):
 	return dicttoxml.dicttoxml(dictionary, attr_type=False)
 
+USER_IDENTITY_SESSION_KEY = "user_identity"
+# Deltas never change once they exist.
+DELTA_MAX_AGE = 365 * 24 * 60 * 60
+
+def is_sha1(string):
+	return len(string) == 40 and all((c in "0123456789abcdef" for c in string))
+
+def get_user_version_cache_key(user_id):
+	return "user_version_{}".format(user_id)
+
+def remember_user_identity(user):
+	"""Stores the user's data in the (signed) session, so that load_user can skip the database for a while.
+	The user's current version is kept in the shared cache. Session copies with another version are outdated.
+	"""
+	timeout = flask.current_app.config.get("USER_IDENTITY_CACHE_TIMEOUT")
+	flask.session[USER_IDENTITY_SESSION_KEY] = dict(id=user.id, version_id=user.version_id, name=user.name, is_moderator=user.is_moderator,
+													expires=time.time() + timeout)
+	cache.set(get_user_version_cache_key(user.id), user.version_id, timeout=timeout)
+
 @login_manager.user_loader
 def load_user(user_id):
 	try:
 		user_id = int(user_id)
 	except:
 		return None
-	return models.User.query.get(user_id)
 
-@cache.memoize()
-def get_all_package_ids(keywords=None, limit_to_tags=None, start=0, limit=None, sort_string=None):
-	packages = models.Package.query
+	identity = flask.session.get(USER_IDENTITY_SESSION_KEY)
+	if identity is not None and identity["id"] == user_id and identity["expires"] > time.time() \
+			and cache.get(get_user_version_cache_key(user_id)) == identity["version_id"]:
+		# This copy is not attached to the database session and must not be added to it.
+		return models.User(id=identity["id"], version_id=identity["version_id"], name=identity["name"], is_moderator=identity["is_moderator"])
+
+	user = models.User.query.get(user_id)
+	if user is not None:
+		remember_user_identity(user)
+	else:
+		flask.session.pop(USER_IDENTITY_SESSION_KEY, None)
+	return user
+
+def get_all_package_ids(keywords=None, **kwargs):
+	# The keyword search needs the database's full text index.
+	catalog_read_model = flask.current_app.extensions.get("catalog_read_model")
+	if catalog_read_model is not None and keywords is None:
+		return catalog_read_model.get_package_ids(cache.get(catalog.GENERATION_CACHE_KEY), **kwargs)
+	metrics.count_cache_lookup("package_ids")
+	if replicas.is_sticky():
+		# The cached lists might come from a replica that does not have the user's changes yet.
+		with replicas.primary():
+			return query_all_package_ids.uncached(keywords=keywords, **kwargs)
+	return query_all_package_ids(keywords=keywords, **kwargs)
+
+def get_package_ids_query(keywords=None, limit_to_tags=None, sort_string=None):
+	"""Returns the query of the IDs of the packages that have all the tags and match any of the keywords, in the requested order.
+	The orders use the indexes on the title and the modification date. See db/check_query_plans.py.
+	"""
+	query = models.db.session.query(models.Package.id)
 	if limit_to_tags is not None:
-		limit_to_tags = set(limit_to_tags)
-		packages = packages.filter(models.Package.tags.any(models.Tag.title.in_(limit_to_tags)))
+		for tag_title in set(limit_to_tags):
+			query = query.filter(models.Package.tags.any(models.Tag.title == tag_title))
 	if keywords is not None:
 		keywords = [slugify.slugify(s) for s in keywords]
 		search_string = " | ".join((k for k in keywords if k))
-		packages = packages.filter(models.Package.search_text.match(search_string))
-	packages = packages.all()
-
-	if limit_to_tags is not None:
-		# The query returns a logical or on the tags. Need a logical and.
-		packages = [p for p in packages if p.has_all_tags(limit_to_tags)]
-
-	if sort_string is not None and len(sort_string) > 0:
-		descending = False
-		if sort_string[0] == "-":
-			descending = True
-			sort_string = sort_string[1:]
-		sort_key = None
-		if sort_string == "votes":
-			sort_key = None # todo
-		elif sort_string == "title":
-			sort_key = lambda p: p.title
-		elif sort_string == "updatedAt":
-			sort_key = lambda p: p.modification_date
-		
-		if sort_key is not None:
-			packages = sorted(packages, key=sort_key, reverse=descending)
+		query = query.filter(models.Package.search_text.match(search_string))
+
+	if sort_string:
+		descending = sort_string[0] == "-"
+		# Sorting by votes is not implemented yet (todo).
+		sort_column = dict(title=models.Package.title, updatedAt=models.Package.modification_date).get(sort_string.lstrip("-"))
+		if sort_column is not None:
+			query = query.order_by(sort_column.desc() if descending else sort_column)
+	# The ID keeps the pages stable for equal titles or dates and is the order for unknown sort strings.
+	# The catalog read model orders the same way.
+	return query.order_by(models.Package.id)
 
-	n_total = len(packages)
-	if start > 0 and start is not None:
-		packages = packages[start:]
+@cache.memoize()
+def query_all_package_ids(keywords=None, limit_to_tags=None, start=0, limit=None, sort_string=None):
+	# Only executed if the result is not cached.
+	metrics.count_cache_miss("package_ids")
+	query = get_package_ids_query(keywords=keywords, limit_to_tags=limit_to_tags, sort_string=sort_string)
+	n_total = query.order_by(None).count()
+	if start is not None and start > 0:
+		query = query.offset(start)
 	if limit is not None:
-		packages = packages[:limit]
-
-	return [package.id for package in packages], n_total
+		query = query.limit(limit)
+	return [package_id for (package_id,) in query.all()], n_total
 
 def get_all_packages(**kwargs):
 	package_ids, n_total = get_all_package_ids(**kwargs)
@@ -102,6 +146,17 @@ def get_package_for_raw_package_id(package_id):
 	
 	return package
 
+def get_package_details_cache_key(package):
+	"""Returns the key of the cached part of the package's details page. See package_details.html.
+	"""
+	return flask_caching.make_template_fragment_key("package_details", vary_on=[package.id.hex, package.modification_date.isoformat()])
+
+def get_package_cache_keys(package):
+	"""Returns the keys of the cached details page and metadata of the package.
+	They are keyed by the modification date, so they only have to be deleted if the package changes without a new one.
+	"""
+	return [get_package_details_cache_key(package), get_package_metadata_cache_key(package.id, package.modification_date)]
+
 def get_logged_in_user(external_id, username, is_moderator=False):
 	try:
 		external_id = int(external_id)
@@ -112,54 +167,40 @@ def get_logged_in_user(external_id, username, is_moderator=False):
 
 	if user:
 		# Update the data in case the name changed etc.
-		user.name = username
-		user.is_moderator = is_moderator
+		if (user.name != username) or (user.is_moderator != is_moderator):
+			# Incremented in the database, so that concurrent logins of the user do not conflict.
+			models.User.query.filter_by(id=user.id).update(dict(name=username, is_moderator=is_moderator, version_id=models.User.version_id + 1),
+															synchronize_session=False)
+			# Reloads the user with the new version.
+			models.db.session.commit()
 	else:
 		# Create a new user and log them in.
 		user = models.User(external_id=external_id, name=username, is_moderator=is_moderator)
 		models.db.session.add(user)
-		models.db.session.flush()
+		models.db.session.commit()
 
-	models.db.session.commit()
 	flask_login.login_user(user, remember=True)
+	remember_user_identity(user)
 	return user
 
-def check_and_remove_resources(hashes):
-	for hash in hashes:
-		remaining_entries = models.Resource.query.filter_by(sha1=hash).count()
-		# Check if there are files with that hash remaining.
-		if remaining_entries > 0:
-			continue
-		resources.resource_manager.remove_resource(hash)
-
-def check_and_prepare_removal_of_orphaned_tags(tag_ids):	
-	"""Note that this does not commit the session but instead has to be executed in another transaction.
-	"""
-	for tag_id in tag_ids:
-		tagged_entries = models.PackageTagAssociation.query.filter_by(tag_id=tag_id).count()
-		if tagged_entries > 0:
-			continue
-		models.db.session.delete(models.Tag.query.get(tag_id))
-	
-
-@app.route('/login', methods=['GET', 'POST'])
+@blueprint.route('/login', methods=['GET', 'POST'])
 def login_page():
 	if flask_login.current_user.is_authenticated:
-		return flask.redirect(flask.url_for("index"))
+		return flask.redirect(flask.url_for("lorry.index"))
 
 	# Assume that SSO is configured.
-	sso_endpoint = app.config.get("SSO_ENDPOINT")
+	sso_endpoint = flask.current_app.config.get("SSO_ENDPOINT")
 	if not sso_endpoint:
-		if app.config.get("DEBUG") == True:
+		if flask.current_app.config.get("DEBUG") == True:
 			# Log in arbitrary users in debug mode.
 			get_logged_in_user(int(flask.request.args["id"]), flask.request.args["username"], flask.request.args["is_moderator"] == "1")
-			return flask.redirect(flask.url_for('index'))
+			return flask.redirect(flask.url_for('lorry.index'))
 		return flask.abort(404)
 	
 	if "sso" in flask.request.args:
 		# The user has already logged in. Process the SSO service response.
 		# Verify the response signature first.
-		if not passwords.verify_sso_response_signature(flask.request.args["sso"].encode(), flask.request.args["sig"], app.config.get("SSO_HMAC_SECRET")):
+		if not passwords.verify_sso_response_signature(flask.request.args["sso"].encode(), flask.request.args["sig"], flask.current_app.config.get("SSO_HMAC_SECRET")):
 			flask.session.clear()
 			return flask.abort(403)
 		# Parse response.
@@ -190,10 +231,10 @@ def login_page():
 		assert flask_login.current_user.is_authenticated
 
 		forward_to = flask.session["forward_to"]
-		if (forward_to is not None) and not is_safe_url(forward_to, allowed_hosts=[app.config.get("own_host")]):
+		if (forward_to is not None) and not is_safe_url(forward_to, allowed_hosts=[flask.current_app.config.get("own_host")]):
 			return flask.abort(400)
 		flask.session.pop("forward_to", None)
-		return flask.redirect(forward_to or flask.url_for('index'))
+		return flask.redirect(forward_to or flask.url_for('lorry.index'))
 
 	flask.session["nonce"] = passwords.generate_nonce()
 	flask.session["forward_to"] = flask.request.args.get('next')
@@ -201,16 +242,16 @@ def login_page():
 	payload = dict(nonce=flask.session["nonce"])
 	payload = urllib.parse.urlencode(payload)
 	payload = base64.b64encode(payload.encode())
-	payload = dict(sig=passwords.generate_sso_payload_signature(payload, app.config.get("SSO_HMAC_SECRET")),
+	payload = dict(sig=passwords.generate_sso_payload_signature(payload, flask.current_app.config.get("SSO_HMAC_SECRET")),
 					sso=payload.decode())
 	return flask.redirect("{}?{}".format(sso_endpoint, urllib.parse.urlencode(payload)))
 
-@app.route('/logout')
+@blueprint.route('/logout')
 @flask_login.login_required
 def logout_page():
 	flask_login.logout_user()
 	flask.session.clear()
-	response = flask.make_response(flask.redirect(flask.url_for("index")))
+	response = flask.make_response(flask.redirect(flask.url_for("lorry.index")))
 	# Forcibly expire the "remember_me" token.
 	response.set_cookie("remember_token", "", expires=datetime.datetime.now() - datetime.timedelta(days=1))
 	return response
@@ -220,9 +261,26 @@ def get_all_packages_for_suggestion_list():
 	package_data = [dict(value="{} {}".format(id.hex, title)) for (id, title) in package_data]
 	return json.dumps(package_data)
 
-@app.route('/upload', methods=['GET', 'POST'], defaults=dict(package_id=None))
-@app.route('/upload/<string:package_id>', methods=['GET', 'POST'])
+def get_package_list_limit():
+	"""Returns the limit argument of package lists, clamped to 1 to PACKAGE_LIST_MAX_LIMIT.
+	"""
+	limit = flask.request.args.get("limit", default=50, type=int)
+	return min(max(1, limit), flask.current_app.config.get("PACKAGE_LIST_MAX_LIMIT"))
+
+def get_package_list_cost():
+	"""Package lists cost more tokens with large limits and with a search query, which can not use the catalog read model.
+	"""
+	limit = get_package_list_limit()
+	search_query = flask.request.args.get("q", default=None, type=str)
+	return max(1, math.ceil(limit / 50)) + (2 if search_query else 0)
+
+def get_upload_cost():
+	return 10 if flask.request.method == "POST" else 1
+
+@blueprint.route('/upload', methods=['GET', 'POST'], defaults=dict(package_id=None))
+@blueprint.route('/upload/<string:package_id>', methods=['GET', 'POST'])
 @flask_login.login_required
+@admission_controlled("upload", get_upload_cost)
 def upload(package_id):
 
 	existing_package = None
@@ -254,8 +312,12 @@ def upload(package_id):
 		form.author.render_kw = dict(readonly=True)
 
 	if form.validate_on_submit():
-		# Files on the file system will be removed only after all sessions are committed.
 		removed_file_hashes = []
+		# Related packages show this package on their details page and in their metadata, e.g. in the list of dependencies.
+		# Their modification date does not change, so their cached pages and metadata are invalidated after committing.
+		outdated_cache_keys = set()
+		# Packages whose static pages have to be rendered again.
+		outdated_static_page_ids = set()
 
 		try:
 			title, author, description, tags, raw_dependencies = form.title.data, form.author.data, form.description.data, form.tags.data, form.dependencies.data
@@ -291,7 +353,7 @@ def upload(package_id):
 				if len(secure_filename) == 0:
 					continue
 				extension = secure_filename.split(".")[-1]
-				if (extension not in app.config.get("ALLOWED_FILE_EXTENSIONS")):
+				if (extension not in flask.current_app.config.get("ALLOWED_FILE_EXTENSIONS")):
 					raise ValidationError("File extension not allowed: {}".format(extension))
 				uploaded_files[secure_filename] = file
 				extension_tag = ".{}".format(extension)
@@ -309,27 +371,17 @@ def upload(package_id):
 					models.db.session.add(resource)
 					resources.append(resource)
 				models.db.session.flush()
+				for resource in resources:
+					jobs.enqueue("index_resource_contents", resource_id=resource.id.hex)
+					jobs.enqueue("compress_resource", sha1=resource.sha1)
 				return resources
 
 			# Search for or create tags.
 			def get_all_tag_objects():
-				tag_objects = []
-				for tag_name in sorted(tag_names):
-					if len(tag_name) < 2:
-						continue
-					if tag_name in (".ocs", ".ocf"):
-						tag_name = ".scenario"
-					elif tag_name == ".ocd":
-						tag_name = ".objects"
-					
-					# The tags are already escaped and normalized here.
-					tag = models.Tag.query.filter_by(title=tag_name).first()
-					if tag is None:
-						tag = models.Tag(title=tag_name)
-						models.db.session.add(tag)
-					tag_objects.append(tag)
-				models.db.session.flush()
-				return tag_objects
+				normalized_tag_names = set((models.Tag.get_normalized_title(tag_name) for tag_name in tag_names))
+				normalized_tag_names.discard(None)
+				# The tags are already escaped and normalized here.
+				return models.Tag.get_or_create_all(normalized_tag_names)
 
 			if not is_updating_existing_package:
 				if len(uploaded_files) == 0:
@@ -339,12 +391,21 @@ def upload(package_id):
 				# Prepare new entry.
 				new_entry = models.Package(title=title, author=author, description=description, long_description=long_description,
 										   owner=flask_login.current_user.id, tags=get_all_tag_objects())
-				new_entry.update_search_text()
+				new_entry.update_rendered_long_description()
 				new_entry.resources = save_files_from_form()
+				new_entry.create_release(flask.current_app.config.get("RELEASES_KEPT_PER_PACKAGE"))
 				models.db.session.add(new_entry)
 				models.db.session.flush()
 				package_id = new_entry.id.hex
+				jobs.enqueue("update_search_text", package_id=package_id)
+				outdated_static_page_ids.add(new_entry.id)
 			else:
+				related_packages = [d.dependency for d in existing_package.dependencies] + [d.package for d in existing_package.dependants] + dependencies
+				for related_package in related_packages:
+					outdated_cache_keys.update(get_package_cache_keys(related_package))
+					outdated_static_page_ids.add(related_package.id)
+				outdated_static_page_ids.add(existing_package.id)
+
 				# Remember old tags so we know what we might need to delete later.
 				old_tag_ids = set()
 				for tag in existing_package.tags:
@@ -357,11 +418,13 @@ def upload(package_id):
 					for file in existing_package.resources:
 						if file.id.hex not in removed_file_hashes:
 							removed_file_hashes.append(file.sha1)
+					for release in existing_package.releases:
+						removed_file_hashes.extend((f.sha1 for f in release.files))
 					# All the other things will be deleted in a cascade.
 					models.db.session.delete(existing_package)
 					models.db.session.flush()
 					package_id = None
-					check_and_prepare_removal_of_orphaned_tags(old_tag_ids)
+					jobs.enqueue("remove_orphaned_tags", tag_ids=list(old_tag_ids))
 				else:
 					# Not deleted this time. Update everything.
 					search_index_changed = (existing_package.title != title) or (existing_package.author != author) or (existing_package.description != description)
@@ -371,10 +434,11 @@ def upload(package_id):
 						existing_package.author = author
 					existing_package.description = description
 					existing_package.long_description = long_description
+					existing_package.update_rendered_long_description()
 					existing_package.modification_date = datetime.datetime.now(datetime.timezone.utc)
 
 					if search_index_changed:
-						existing_package.update_search_text()
+						jobs.enqueue("update_search_text", package_id=existing_package.id.hex)
 
 					# Remove all explicitely removed or freshly uploaded files.
 					files_to_remove = set((f for f in form.remove_existing_files.data))
@@ -391,6 +455,8 @@ def upload(package_id):
 					existing_package.resources.extend(save_files_from_form())
 					if (len(existing_package.resources) + len(uploaded_files)) == 0:
 						raise ValidationError("Need at least one remaining file.")
+					# Files of releases that are dropped now are removed, too.
+					removed_file_hashes.extend(existing_package.create_release(flask.current_app.config.get("RELEASES_KEPT_PER_PACKAGE")))
 
 					# Update tags with all old file extensions.
 					for resource in existing_package.resources:
@@ -404,7 +470,8 @@ def upload(package_id):
 					# Update tags.
 					existing_package.tags = get_all_tag_objects()
 					removed_tags = old_tag_ids - set((tag.id for tag in existing_package.tags))
-					check_and_prepare_removal_of_orphaned_tags(removed_tags)
+					if removed_tags:
+						jobs.enqueue("remove_orphaned_tags", tag_ids=list(removed_tags))
 
 					# Remove old dependencies.
 					existing_dependencies = set()
@@ -418,10 +485,16 @@ def upload(package_id):
 						if dependency.id not in existing_dependencies:
 							existing_package.dependencies.append(models.PackageDependencies(dependency))
 
+			# Files on the file system are removed by the job worker after the commit.
+			if removed_file_hashes:
+				jobs.enqueue("remove_resources", hashes=removed_file_hashes)
+			jobs.enqueue_static_pages(outdated_static_page_ids)
 			models.db.session.commit()
+			replicas.stick_to_primary()
 
-			if removed_file_hashes:
-				check_and_remove_resources(removed_file_hashes)
+			catalog.bump_generation(cache)
+			if outdated_cache_keys:
+				cache.delete_many(*outdated_cache_keys)
 
 		except ValidationError as e:
 			models.db.session.rollback()
@@ -429,8 +502,8 @@ def upload(package_id):
 											dependencies_whitelist=get_all_packages_for_suggestion_list())
 
 		if package_id is not None:
-			return flask.redirect(flask.url_for("package_details_page", package_id=package_id))
-		return flask.redirect(flask.url_for("index"))
+			return flask.redirect(flask.url_for("lorry.package_details_page", package_id=package_id))
+		return flask.redirect(flask.url_for("lorry.index"))
 
 	return flask.render_template('upload.html', form=form, error="", existing_package=existing_package,
 									dependencies_whitelist=get_all_packages_for_suggestion_list())
@@ -441,7 +514,7 @@ def get_packages_for_current_request():
 	search_query = request.args.get("q", default=None, type=str)
 	sort_string = request.args.get("sort", default="-updatedAt", type=str)
 	tags = request.args.get("tags", default=None, type=str)
-	limit = request.args.get("limit", default=50, type=int)
+	limit = get_package_list_limit()
 	offset = request.args.get("skip", default=0, type=int)
 
 	page_metadata = dict(search_query=search_query, sort_string=sort_string, tags=tags, limit=limit)
@@ -454,20 +527,27 @@ def get_packages_for_current_request():
 
 	return packages, n_total, offset, limit, page_metadata
 
-@app.route("/")
+@blueprint.route("/")
+@admission_controlled("listing", get_package_list_cost)
+@replicas.read_only
 def index():
-	from flask import request
+	return render_index_page()
 
+def render_index_page():
+	"""Renders the package list for the arguments of the current request. Also used by the static page publisher.
+	"""
 	packages, n_total, offset, limit, page_metadata = get_packages_for_current_request()
 	total_pages = math.ceil(n_total / limit)
 	page_index = math.ceil(offset / limit)
 
-	package_list_cache_key = "_".join((p.id.hex for p in packages))
+	# The modification dates keep lists that were rendered from a lagging replica from being shown to users who read from the primary.
+	package_list_cache_key = "_".join(("{}{}".format(p.id.hex, p.modification_date.timestamp()) for p in packages))
 
 	return render_template("overview.html", packages=packages, total_pages=total_pages, page_index=page_index, n_total=n_total,
 							previous_offset=offset - limit, next_offset=offset + limit, page_metadata=page_metadata, package_list_cache_key=package_list_cache_key)
 
-@app.route("/uploads/<string:package_id>", methods=["GET"])
+@blueprint.route("/uploads/<string:package_id>", methods=["GET"])
+@replicas.read_only
 def package_details_page(package_id):
 
 	package = get_package_for_raw_package_id(package_id)
@@ -477,15 +557,18 @@ def package_details_page(package_id):
 
 	return render_template("package_details.html", package=package)
 
-@app.route("/fetch_tag_suggestion", methods=["GET"])
+@blueprint.route("/fetch_tag_suggestion", methods=["GET"])
 @flask_login.login_required
+@admission_controlled("suggestion")
+@replicas.read_only
 def fetch_tag_suggestion():
 
 	tag_string = slugify.slugify(flask.request.args.get("tag"))
 	possible_tags = [tag_string] + [t.title for t in models.Tag.query.filter(models.Tag.title.like("%{}%".format(tag_string))).all() if t.title[0] != "."]
 	return flask.jsonify([dict(value=d, searchBy=tag_string) for d in possible_tags])
 
-@app.route("/api/uploads/<string:package_id>", methods=["GET"])
+@blueprint.route("/api/uploads/<string:package_id>", methods=["GET"])
+@replicas.read_only
 def get_package_info(package_id):
 
 	package = get_package_for_raw_package_id(package_id)
@@ -498,7 +581,75 @@ def get_package_info(package_id):
 	return flask.Response(dict_to_xml(package_data), mimetype='text/xml')
 
 
-@app.route("/api/uploads", methods=["GET"])
+def get_package_metadata_cache_key(package_id, modification_date):
+	return "package_metadata_{}_{}".format(package_id.hex, modification_date.isoformat())
+
+def get_detailed_package_dicts(package_ids):
+	"""Returns the detailed dictionaries of the packages that exist, in the order of package_ids.
+	Costs one query if all are cached and two otherwise.
+	The cache is keyed by the modification date. Changes that do not set it, such as changing or deleting a related package,
+	have to delete the cached entries, see get_package_cache_keys.
+	"""
+	modification_dates = dict(models.db.session.query(models.Package.id, models.Package.modification_date)
+								.filter(models.Package.id.in_(package_ids)).all())
+	package_ids = [package_id for package_id in package_ids if package_id in modification_dates]
+	cache_keys = [get_package_metadata_cache_key(package_id, modification_dates[package_id]) for package_id in package_ids]
+	package_dicts = dict(zip(package_ids, cache.get_many(*cache_keys) if cache_keys else []))
+
+	missing_ids = [package_id for (package_id, package_dict) in package_dicts.items() if package_dict is None]
+	metrics.count_cache_lookup("package_metadata", len(package_ids))
+	metrics.count_cache_miss("package_metadata", len(missing_ids))
+	if missing_ids:
+		eager_loading = (sqlalchemy.orm.selectinload(models.Package.tags), sqlalchemy.orm.selectinload(models.Package.resources),
+						sqlalchemy.orm.selectinload(models.Package.dependencies), sqlalchemy.orm.selectinload(models.Package.releases))
+		new_dicts = dict()
+		for package in models.Package.query.options(*eager_loading).filter(models.Package.id.in_(missing_ids)).all():
+			package_dicts[package.id] = package.to_dict(detailed=True)
+			new_dicts[get_package_metadata_cache_key(package.id, package.modification_date)] = package_dicts[package.id]
+		cache.set_many(new_dicts, timeout=flask.current_app.config.get("PACKAGE_METADATA_CACHE_TIMEOUT"))
+
+	# A package might have been deleted between the two queries.
+	return [package_dicts[package_id] for package_id in package_ids if package_dicts[package_id] is not None]
+
+@blueprint.route("/api/uploads/batch", methods=["GET", "POST"])
+@replicas.read_only
+def get_package_info_batch():
+	"""Returns the detailed information of all packages in the comma-separated ids parameter.
+	Unknown IDs are skipped. Clients should POST the ids as form data: the request line of a GET request with many IDs
+	exceeds the limit of common servers, e.g. 4094 bytes in gunicorn.
+	"""
+	package_ids = []
+	for raw_package_id in flask.request.values.get("ids", default="", type=str).split(","):
+		try:
+			package_id = uuid.UUID(raw_package_id)
+		except ValueError:
+			continue
+		if package_id not in package_ids:
+			package_ids.append(package_id)
+
+	limit = flask.current_app.config.get("BATCH_METADATA_LIMIT")
+	if len(package_ids) > limit:
+		flask.abort(400, description="At most {} IDs per request.".format(limit))
+
+	reply = dict(resources=get_detailed_package_dicts(package_ids))
+	return flask.Response(dict_to_xml(reply), mimetype='text/xml')
+
+@blueprint.route("/api/uploads/<string:package_id>/releases", methods=["GET"])
+@replicas.read_only
+def get_package_releases(package_id):
+
+	package = get_package_for_raw_package_id(package_id)
+
+	if package is not None:
+		releases_data = dict(releases=[r.to_dict() for r in package.releases])
+	else:
+		releases_data = dict()
+
+	return flask.Response(dict_to_xml(releases_data), mimetype='text/xml')
+
+@blueprint.route("/api/uploads", methods=["GET"])
+@admission_controlled("listing", get_package_list_cost)
+@replicas.read_only
 def get_package_list():
 	
 	packages, n_total, offset, limit, page_metadata = get_packages_for_current_request()
@@ -513,7 +664,8 @@ def get_package_list():
 
 	return flask.Response(dict_to_xml(reply), mimetype='text/xml')
 
-@app.route("/api/files/<string:file_id>", methods=["GET"])
+@blueprint.route("/api/files/<string:file_id>", methods=["GET"])
+@replicas.read_only
 def download_file(file_id):
 
 	try:
@@ -523,8 +675,50 @@ def download_file(file_id):
 		file_info = None
 
 	if file_info is not None:
-		return flask.send_file(resources.resource_manager.get_resource_path(file_info.sha1),
-							mimetype="application/octet-stream",
+		path, encoding = resources.resource_manager.get_encoded_resource_path(file_info.sha1, flask.request.accept_encodings)
+		response = flask.send_file(path, mimetype="application/octet-stream",
 							as_attachment=True, download_name=file_info.original_filename)
+		if encoding is not None:
+			response.headers["Content-Encoding"] = encoding
+		response.vary.add("Accept-Encoding")
+		metrics.increment("lorry_download_bytes_total", value=path.stat().st_size)
+		return response
 
 	flask.abort(404, description="File not found.")
+
+def is_delta_offered(old_sha1, new_sha1):
+	"""Returns whether a delta is generated from old_sha1 to new_sha1: from a file of a release to the current file of
+	the same name in the same package. This bounds the number of deltas by the number of released files.
+	"""
+	current_file = sqlalchemy.and_(models.Resource.package_id == models.Release.package_id,
+									models.Resource.original_filename == models.ReleaseFile.original_filename)
+	return models.db.session.query(models.ReleaseFile.id).join(models.Release, models.ReleaseFile.release_id == models.Release.id) \
+		.join(models.Resource, current_file) \
+		.filter(models.ReleaseFile.sha1 == old_sha1, models.Resource.sha1 == new_sha1).first() is not None
+
+@blueprint.route("/api/deltas/<string:old_sha1>/<string:new_sha1>", methods=["GET"])
+@admission_controlled("delta")
+def download_delta(old_sha1, new_sha1):
+	"""Serves a bsdiff patch that turns a file of an older release of a package into the current file of the same name.
+	Answers 202 with Retry-After while the patch is generated, and 404 if there is no patch. Then the whole file has to be downloaded.
+	"""
+	if resources.bsdiff4 is None or old_sha1 == new_sha1 or not (is_sha1(old_sha1) and is_sha1(new_sha1)):
+		flask.abort(404, description="Delta not available.")
+
+	delta_path = resources.resource_manager.get_delta_path(old_sha1, new_sha1)
+	if not delta_path.exists():
+		if not is_delta_offered(old_sha1, new_sha1):
+			flask.abort(404, description="Delta not available.")
+		if jobs.enqueue_once("create_delta", old_sha1=old_sha1, new_sha1=new_sha1):
+			models.db.session.commit()
+		response = flask.Response(status=202)
+		response.headers["Retry-After"] = str(flask.current_app.config.get("DELTA_RETRY_AFTER"))
+		return response
+
+	delta_size = delta_path.stat().st_size
+	if delta_size == 0:
+		# The delta would not have been meaningfully smaller than the file.
+		flask.abort(404, description="Delta not available.")
+	metrics.increment("lorry_download_bytes_total", value=delta_size)
+	return flask.send_file(delta_path, mimetype="application/octet-stream", as_attachment=True,
+							download_name="{}-{}.bsdiff".format(old_sha1, new_sha1), max_age=DELTA_MAX_AGE)
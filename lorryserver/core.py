@@ -1,14 +1,23 @@
 import os
 
 import flask
+import flask_caching
 import flask_login
 
-app_singleton = None
+# Extensions are created without an application and bound to one in create_flask_application.
+cache = flask_caching.Cache()
+login_manager = flask_login.LoginManager()
 
 def create_flask_application(test_config=None):
-    global app_singleton
-    if app_singleton is not None:
-        return app_singleton
+    """Creates and configures a new application.
+    The models and views are only imported here, so that importing them has no side effects.
+    """
+    import flaskext.markdown
+    import werkzeug.middleware.proxy_fix
+
+    from . import app as views
+    from .db import models, replicas
+    from .utils import metrics, profiling, resources
 
     # create and configure the app
     app = flask.Flask(__name__, instance_relative_config=False)
@@ -27,14 +36,18 @@ def create_flask_application(test_config=None):
     except OSError:
         pass
 
-    app_singleton = app
-    return app_singleton
-
-login_manager_singleton = None
-def get_login_manager():
-	global login_manager_singleton
-	if login_manager_singleton is not None:
-		return login_manager_singleton
-	login_manager_singleton = flask_login.LoginManager()
-	login_manager_singleton.init_app(create_flask_application())
-	return login_manager_singleton
\ No newline at end of file
+    replicas.add_replica_binds(app.config)
+    if app.config.get("PROXY_FIX_X_FOR"):
+        app.wsgi_app = werkzeug.middleware.proxy_fix.ProxyFix(app.wsgi_app, x_for=app.config.get("PROXY_FIX_X_FOR"))
+    models.db.init_app(app)
+    cache.init_app(app)
+    login_manager.init_app(app)
+    flaskext.markdown.Markdown(app)
+    resources.resource_manager.set_config(app.config)
+    app.register_blueprint(views.blueprint)
+    if app.config.get("METRICS_ENABLED"):
+        metrics.init_app(app)
+    if app.config.get("PROFILING_ENABLED"):
+        profiling.init_app(app)
+
+    return app
@@ -0,0 +1,264 @@
+"""Imports a large archive of packages, e.g. when migrating from an older mod database.
+
+The manifest is a JSON lines file with one package per line:
+
+	{"key": "legacy-42", "title": "Caedes", "author": "Zapper", "owner_external_id": 65, "owner_name": "Zapper",
+	 "description": "...", "long_description": "...", "tags": ["melee"], "dependencies": ["legacy-7"],
+	 "files": ["caedes/Caedes.ocs"], "creation_date": "2012-05-01T12:00:00+00:00", "modification_date": "2013-01-01T00:00:00+00:00"}
+
+Only key, title and files are required. File paths are relative to the manifest and dependencies refer to the keys
+of other packages. The IDs of the packages and files are derived from the keys, so an interrupted import can simply be
+started again: packages that already exist are skipped and files that are already stored are not copied again.
+
+The manifest is checked like uploads before anything is imported: files need one of the ALLOWED_FILE_EXTENSIONS and
+the file names of a package must be unique. Dependencies that would create a cycle are skipped, as for uploads.
+
+Files are hashed and copied in a process pool. The rows of every batch of packages are inserted with a few
+multi-row statements in one transaction. The job worker indexes and compresses the imported files afterwards and publishes the static pages, if enabled.
+
+Usage: python3 -m lorryserver.db.bulk_import manifest.jsonl [--batch-size N] [--processes N]
+"""
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import pathlib
+import uuid
+
+import slugify
+import sqlalchemy
+import werkzeug.utils
+from sqlalchemy.dialects import postgresql
+
+# Namespace of the package IDs that are derived from the manifest keys. Changing it would import everything again.
+PACKAGE_ID_NAMESPACE = uuid.UUID("6f1a3c52-8e0b-4d7a-b1f4-2c9e5d8a7b30")
+
+def get_package_id(key):
+	return uuid.uuid5(PACKAGE_ID_NAMESPACE, str(key))
+
+def get_resource_id(package_id, filename):
+	return uuid.uuid5(package_id, filename)
+
+def parse_date(date_string, default):
+	if not date_string:
+		return default
+	date = datetime.datetime.fromisoformat(date_string)
+	if date.tzinfo is None:
+		date = date.replace(tzinfo=datetime.timezone.utc)
+	return date
+
+def hash_and_store_file(source_path, resources_path):
+	"""Returns the size, SHA1 and MD5 of the file and copies it to the resources, unless a file with the same SHA1 is there.
+	Runs in the process pool.
+	"""
+	from ..utils.resources import ResourceManager
+
+	sha1, md5 = hashlib.sha1(), hashlib.md5()
+	size = 0
+	with open(source_path, "rb") as f:
+		while True:
+			data = f.read(2**20)
+			if not data:
+				break
+			sha1.update(data)
+			md5.update(data)
+			size += len(data)
+	ResourceManager(dict(RESOURCES_PATH=resources_path)).store_copy_from_filesystem(sha1.hexdigest(), source_path)
+	return size, sha1.hexdigest(), md5.hexdigest()
+
+def read_manifest(manifest_path, allowed_extensions):
+	"""Returns the manifest entries. Raises ValueError if an entry is incomplete, refers to files that do not exist,
+	has files with an extension that is not allowed or several files with the same name.
+	"""
+	base_path = pathlib.Path(manifest_path).parent
+	entries = []
+	keys = set()
+	with open(manifest_path, encoding="utf-8") as f:
+		for (line_number, line) in enumerate(f, 1):
+			if not line.strip():
+				continue
+			entry = json.loads(line)
+			if not (entry.get("key") and entry.get("title") and entry.get("files")):
+				raise ValueError("Line {}: key, title and files are required.".format(line_number))
+			if entry["key"] in keys:
+				raise ValueError("Line {}: duplicate key {}.".format(line_number, entry["key"]))
+			keys.add(entry["key"])
+			entry["files"] = [base_path / path for path in entry["files"]]
+			filenames = set()
+			for path in entry["files"]:
+				if not path.is_file():
+					raise ValueError("Line {}: file not found: {}".format(line_number, path))
+				filename = werkzeug.utils.secure_filename(path.name)
+				if filename.split(".")[-1] not in allowed_extensions:
+					raise ValueError("Line {}: file extension not allowed: {}".format(line_number, path))
+				if filename in filenames:
+					raise ValueError("Line {}: duplicate file name: {}".format(line_number, filename))
+				filenames.add(filename)
+			entries.append(entry)
+	return entries
+
+def get_owner_ids(models, entries):
+	"""Returns the user IDs for the owner_external_id values of the entries. Missing users are created.
+	"""
+	owner_names = dict(((e["owner_external_id"], e.get("owner_name") or e.get("author")) for e in entries if e.get("owner_external_id") is not None))
+	owner_ids = dict(models.db.session.query(models.User.external_id, models.User.id).filter(models.User.external_id.in_(owner_names)).all())
+	new_users = [models.User(external_id=external_id, name=name) for (external_id, name) in owner_names.items() if external_id not in owner_ids]
+	if new_users:
+		models.db.session.add_all(new_users)
+		models.db.session.commit()
+		owner_ids.update(((user.external_id, user.id) for user in new_users))
+	return owner_ids
+
+def import_batch(models, entries, pool, resources_path, owner_ids):
+	"""Inserts the packages of the entries, which must not exist yet, in one transaction.
+	"""
+	session = models.db.session
+	now = datetime.datetime.now(datetime.timezone.utc)
+
+	source_paths = [str(path) for entry in entries for path in entry["files"]]
+	file_infos = dict(zip(source_paths, pool.map(hash_and_store_file, source_paths, itertools.repeat(resources_path), chunksize=4)))
+
+	package_rows, resource_rows, tag_titles, search_strings, job_rows = [], [], dict(), [], []
+	release_files = dict()
+	for entry in entries:
+		package_id = get_package_id(entry["key"])
+		owner = owner_ids.get(entry.get("owner_external_id"))
+		creation_date = parse_date(entry.get("creation_date"), now)
+		modification_date = parse_date(entry.get("modification_date"), creation_date)
+		long_description = entry.get("long_description")
+		long_description_html, long_description_hash = models.render_long_description(long_description or "")
+		package_rows.append(dict(id=package_id, title=entry["title"][:64], description=(entry.get("description") or "")[:150],
+								long_description=long_description, long_description_html=long_description_html,
+								long_description_hash=long_description_hash, author=entry.get("author"), owner=owner,
+								creation_date=creation_date, modification_date=modification_date))
+
+		# The same normalization as for uploads: slugified tags plus the file extensions.
+		titles = set((slugify.slugify(tag) for tag in entry.get("tags", ())))
+		files = []
+		for path in entry["files"]:
+			filename = werkzeug.utils.secure_filename(path.name)
+			size, sha1, md5 = file_infos[str(path)]
+			resource_id = get_resource_id(package_id, filename)
+			resource_rows.append(dict(id=resource_id, package_id=package_id, owner=owner, original_filename=filename, size=size, sha1=sha1, md5=md5,
+									creation_date=creation_date, modification_date=modification_date))
+			files.append(dict(original_filename=filename, size=size, sha1=sha1, md5=md5))
+			job_rows.append(dict(kind="index_resource_contents", payload=dict(resource_id=resource_id.hex)))
+			job_rows.append(dict(kind="compress_resource", payload=dict(sha1=sha1)))
+			titles.add(path.suffix.lower())
+		titles = set((models.Tag.get_normalized_title(title) for title in titles))
+		titles.discard(None)
+		tag_titles[package_id] = titles
+		release_files[package_id] = files
+		search_strings.append(dict(package_id=package_id, search_string=models.get_search_string(
+			(entry["title"], entry.get("description"), entry.get("author")) + tuple(titles))))
+
+	session.execute(postgresql.insert(models.Package.__table__), package_rows)
+	session.execute(postgresql.insert(models.Resource.__table__), resource_rows)
+
+	tag_ids = dict(((tag.title, tag.id) for tag in models.Tag.get_or_create_all(set().union(*tag_titles.values()))))
+	association_rows = [dict(package_id=package_id, tag_id=tag_ids[title]) for (package_id, titles) in tag_titles.items() for title in titles]
+	if association_rows:
+		session.execute(postgresql.insert(models.PackageTagAssociation.__table__), association_rows)
+
+	package_table = models.Package.__table__
+	session.execute(sqlalchemy.update(package_table).where(package_table.c.id == sqlalchemy.bindparam("package_id"))
+					.values(search_text=sqlalchemy.func.to_tsvector(sqlalchemy.bindparam("search_string"))), search_strings)
+
+	release_table = models.Release.__table__
+	release_ids = session.execute(postgresql.insert(release_table).returning(release_table.c.package_id, release_table.c.id),
+								[dict(package_id=package_id, version=1, creation_date=now) for package_id in release_files]).all()
+	release_file_rows = [dict(release_id=release_id, **f) for (package_id, release_id) in release_ids for f in release_files[package_id]]
+	session.execute(postgresql.insert(models.ReleaseFile.__table__), release_file_rows)
+
+	session.execute(postgresql.insert(models.Job.__table__), job_rows)
+	session.commit()
+
+def get_acyclic_dependencies(entries):
+	"""Returns the (package key, dependency key) pairs of the entries, without the ones that would close a cycle.
+	The pairs are checked in the order of the manifest, so the result is the same when an import is repeated.
+	"""
+	dependencies = dict()
+	def depends_on(key, other_key):
+		visited, stack = set(), [key]
+		while stack:
+			current_key = stack.pop()
+			if current_key == other_key:
+				return True
+			if current_key not in visited:
+				visited.add(current_key)
+				stack.extend(dependencies.get(current_key, ()))
+		return False
+
+	pairs = []
+	for entry in entries:
+		for dependency_key in entry.get("dependencies", ()):
+			if not depends_on(dependency_key, entry["key"]):
+				dependencies.setdefault(entry["key"], []).append(dependency_key)
+				pairs.append((entry["key"], dependency_key))
+	return pairs
+
+def import_dependencies(models, entries, batch_size):
+	"""Adds the dependencies between the imported packages. Returns the numbers of added and skipped dependencies.
+	Dependencies on packages that do not exist and dependencies that would create a cycle are skipped.
+	"""
+	session = models.db.session
+	pairs = get_acyclic_dependencies(entries)
+	n_cyclic = sum((len(entry.get("dependencies", ())) for entry in entries)) - len(pairs)
+	dependency_rows = [dict(package_id=get_package_id(key), dependency_id=get_package_id(dependency_key)) for (key, dependency_key) in pairs]
+	existing_ids = set((package_id for (package_id,) in session.query(models.Package.id)
+						.filter(models.Package.id.in_(set((row["dependency_id"] for row in dependency_rows)))).all()))
+	dependency_rows = [row for row in dependency_rows if row["dependency_id"] in existing_ids]
+	for start in range(0, len(dependency_rows), batch_size):
+		session.execute(postgresql.insert(models.PackageDependencies.__table__).on_conflict_do_nothing(), dependency_rows[start:start + batch_size])
+		session.commit()
+	return len(dependency_rows), n_cyclic
+
+def enqueue_static_pages(models, entries, batch_size):
+	"""Lets the job worker publish the static pages of the packages, now that their dependencies are complete.
+	"""
+	from .. import jobs
+
+	package_ids = [get_package_id(entry["key"]) for entry in entries]
+	for start in range(0, len(package_ids), batch_size):
+		jobs.enqueue_static_pages(package_ids[start:start + batch_size])
+	models.db.session.commit()
+
+def bulk_import(manifest_path, batch_size=200, processes=None):
+	from ..core import create_flask_application, cache
+	from . import catalog, models
+
+	app = create_flask_application()
+	entries = read_manifest(manifest_path, app.config.get("ALLOWED_FILE_EXTENSIONS"))
+	with app.app_context(), concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+		session = models.db.session
+		resources_path = app.config.get("RESOURCES_PATH")
+		owner_ids = get_owner_ids(models, entries)
+
+		n_imported = 0
+		for start in range(0, len(entries), batch_size):
+			batch = entries[start:start + batch_size]
+			existing_ids = set((package_id for (package_id,) in session.query(models.Package.id)
+								.filter(models.Package.id.in_([get_package_id(e["key"]) for e in batch])).all()))
+			new_entries = [e for e in batch if get_package_id(e["key"]) not in existing_ids]
+			if new_entries:
+				import_batch(models, new_entries, pool, resources_path, owner_ids)
+				n_imported += len(new_entries)
+			print("{} of {} packages, {} imported".format(start + len(batch), len(entries), n_imported), flush=True)
+
+		n_dependencies, n_cyclic = import_dependencies(models, entries, batch_size)
+		enqueue_static_pages(models, entries, batch_size)
+		catalog.bump_generation(cache)
+		print("Imported {} packages, skipped {} that already existed, {} dependencies, skipped {} circular dependencies.".format(
+			n_imported, len(entries) - n_imported, n_dependencies, n_cyclic), flush=True)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("manifest", help="JSON lines file with one package per line.")
+	parser.add_argument("--batch-size", type=int, default=200, help="Packages per transaction.")
+	parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Processes for hashing and copying files.")
+	args = parser.parse_args()
+	bulk_import(args.manifest, args.batch_size, args.processes)
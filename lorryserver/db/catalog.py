@@ -0,0 +1,148 @@
+import array
+import threading
+import time
+import uuid
+
+import sqlalchemy
+
+from . import replicas
+
+# Changes whenever a package is saved. Lets the read models know when to refresh.
+GENERATION_CACHE_KEY = "catalog_generation"
+
+def bump_generation(cache):
+	cache.set(GENERATION_CACHE_KEY, uuid.uuid4().hex, timeout=0)
+
+class CatalogEntry():
+	"""The data of one package that is needed to filter and sort the package list.
+	"""
+	__slots__ = ("id", "title", "author", "description", "modification_date", "tag_ids")
+
+	def __init__(self, id, title, author, description, modification_date, tag_ids):
+		self.id = id
+		self.title = title
+		self.author = author
+		self.description = description
+		self.modification_date = modification_date
+		self.tag_ids = tag_ids
+
+class CatalogSnapshot():
+	"""Immutable, position-based view of all catalog entries.
+	Tags are stored as bitsets (python integers) over the entry positions, so filtering by tags is a chain of ANDs.
+	"""
+	__slots__ = ("ids", "all_positions", "tag_bitsets", "orderings")
+
+	def __init__(self, entries, tag_titles, title_ranks):
+		"""The entries must be sorted by ID. title_ranks maps the IDs to the position of their title in the database's
+		collation, with equal ranks for equal titles.
+		"""
+		entries = list(entries)
+		self.ids = [entry.id for entry in entries]
+		self.all_positions = (1 << len(entries)) - 1
+
+		self.tag_bitsets = dict()
+		for position, entry in enumerate(entries):
+			for tag_id in entry.tag_ids:
+				title = tag_titles.get(tag_id)
+				if title is not None:
+					self.tag_bitsets[title] = self.tag_bitsets.get(title, 0) | (1 << position)
+
+		# Pre-sorted positions for all sort strings that get_package_ids understands, ascending and descending.
+		# Like app.get_package_ids_query, ties are ordered by ID in both directions. As the positions are in the order of the IDs
+		# and sorting is stable, also in reverse, sorting the positions does that.
+		positions = range(len(entries))
+		sort_keys = dict(title=lambda p: title_ranks.get(entries[p].id, 0), updatedAt=lambda p: entries[p].modification_date)
+		self.orderings = dict()
+		for (sort_name, sort_key) in sort_keys.items():
+			self.orderings[sort_name] = array.array("l", sorted(positions, key=sort_key))
+			self.orderings["-" + sort_name] = array.array("l", sorted(positions, key=sort_key, reverse=True))
+
+	def get_package_ids(self, limit_to_tags=None, start=0, limit=None, sort_string=None):
+		"""Works like app.get_all_package_ids, except for keyword search which needs the database.
+		"""
+		selected_positions = self.all_positions
+		if limit_to_tags is not None:
+			for title in set(limit_to_tags):
+				selected_positions &= self.tag_bitsets.get(title, 0)
+
+		# Unknown sort strings fall back to the order of the IDs.
+		ordering = self.orderings.get(sort_string, range(len(self.ids)))
+
+		if selected_positions == self.all_positions:
+			ids = [self.ids[position] for position in ordering]
+		else:
+			mask = selected_positions.to_bytes((len(self.ids) + 7) // 8, "little")
+			ids = [self.ids[position] for position in ordering if (mask[position >> 3] >> (position & 7)) & 1]
+
+		n_total = len(ids)
+		if start is not None and start > 0:
+			ids = ids[start:]
+		if limit is not None:
+			ids = ids[:limit]
+		return ids, n_total
+
+class CatalogReadModel():
+	"""In-process copy of the package catalog that answers list queries without a database round-trip.
+
+	The model is refreshed when the catalog generation changes or when it is older than max_age seconds.
+	Refreshing only loads the packages that were added or modified since the last refresh, and the tags of all packages.
+	"""
+	def __init__(self, max_age=60):
+		self.max_age = max_age
+		self.lock = threading.Lock()
+		self.entries = dict()
+		self.snapshot = None
+		self.generation = None
+		self.refresh_time = None
+
+	def is_outdated(self, generation):
+		if self.snapshot is None or self.generation != generation:
+			return True
+		return (time.monotonic() - self.refresh_time) > self.max_age
+
+	def get_snapshot(self, generation):
+		if self.is_outdated(generation):
+			with self.lock:
+				# Another thread might have refreshed the model in the meantime.
+				if self.is_outdated(generation):
+					# The generation changes right after a commit, when the replicas might not have the change yet.
+					with replicas.primary():
+						self.refresh()
+					self.generation = generation
+		return self.snapshot
+
+	def get_package_ids(self, generation, **kwargs):
+		return self.get_snapshot(generation).get_package_ids(**kwargs)
+
+	def refresh(self):
+		from . import models
+
+		modification_dates = dict(models.db.session.query(models.Package.id, models.Package.modification_date).all())
+
+		for package_id in set(self.entries) - set(modification_dates):
+			del self.entries[package_id]
+
+		# The tags of all packages are loaded, as the job worker adds tags without changing the modification date.
+		tag_ids = dict()
+		for (package_id, tag_id) in models.db.session.query(models.PackageTagAssociation.package_id, models.PackageTagAssociation.tag_id).all():
+			tag_ids.setdefault(package_id, []).append(tag_id)
+		for (package_id, entry) in self.entries.items():
+			entry.tag_ids = tuple(tag_ids.get(package_id, ()))
+
+		changed_ids = [package_id for (package_id, modification_date) in modification_dates.items()
+						if (package_id not in self.entries) or (self.entries[package_id].modification_date != modification_date)]
+		if changed_ids:
+			rows = models.db.session.query(models.Package.id, models.Package.title, models.Package.author,
+											models.Package.description, models.Package.modification_date) \
+				.filter(models.Package.id.in_(changed_ids)).all()
+			for (package_id, title, author, description, modification_date) in rows:
+				self.entries[package_id] = CatalogEntry(package_id, title, author, description, modification_date,
+														tuple(tag_ids.get(package_id, ())))
+
+		tag_titles = dict(models.db.session.query(models.Tag.id, models.Tag.title).all())
+		# Titles are ranked by the database, as Python can not compare strings in its collation.
+		title_ranks = dict(models.db.session.query(models.Package.id,
+													sqlalchemy.func.dense_rank().over(order_by=models.Package.title)).all())
+		entries = sorted(self.entries.values(), key=lambda entry: entry.id)
+		self.snapshot = CatalogSnapshot(entries, tag_titles, title_ranks)
+		self.refresh_time = time.monotonic()
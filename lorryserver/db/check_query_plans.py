@@ -0,0 +1,43 @@
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+def get_checked_queries(models):
+	"""Returns (name, query, expected index) for the hot queries of the package list, the tag lookups and the file removal.
+	The package list queries are built like the ones of the package list views.
+	"""
+	from .. import app as views
+
+	session = models.db.session
+	some_id = "00000000-0000-0000-0000-000000000000"
+	return [
+		("package list by date", views.get_package_ids_query(sort_string="-updatedAt").offset(50).limit(50), "ix_package_modification_date"),
+		("package list by title", views.get_package_ids_query(sort_string="title").offset(50).limit(50), "ix_package_title"),
+		("package list by tag", views.get_package_ids_query(limit_to_tags=["melee"], sort_string="-updatedAt").limit(50), "ix_tag_title"),
+		("tags by title", session.query(models.Tag.id).filter(models.Tag.title.in_(["melee", "race"])), "ix_tag_title"),
+		("packages by tag", session.query(models.PackageTagAssociation.package_id).filter(models.PackageTagAssociation.tag_id == 1), "packagetagassociation_pkey"),
+		("tags of packages", session.query(models.PackageTagAssociation.tag_id).filter(models.PackageTagAssociation.package_id.in_([some_id])), "ix_packagetagassociation_package_id"),
+		("files of package", session.query(models.Resource.id).filter(models.Resource.package_id == some_id), "ix_resource_package_id"),
+		("files still in use", session.query(models.Resource.sha1).filter(models.Resource.sha1.in_(["0" * 40])), "ix_resource_sha1"),
+		("released files still in use", session.query(models.ReleaseFile.sha1).filter(models.ReleaseFile.sha1.in_(["0" * 40])), "ix_releasefile_sha1"),
+	]
+
+def check_query_plans():
+	"""Prints the EXPLAIN plans of the hot queries and whether they use the expected indexes.
+	Sequential scans are disabled for the check, as the planner prefers them for small tables anyway.
+	Returns whether all queries use their index.
+	"""
+	from ..core import create_flask_application
+	from . import models
+
+	all_ok = True
+	with create_flask_application().app_context():
+		session = models.db.session
+		session.execute(sqlalchemy.text("SET LOCAL enable_seqscan = off"))
+		for (name, query, expected_index) in get_checked_queries(models):
+			sql = str(query.statement.compile(dialect=postgresql.dialect(), compile_kwargs=dict(literal_binds=True)))
+			plan = "\n".join((line for (line,) in session.execute(sqlalchemy.text("EXPLAIN " + sql)).all()))
+			is_ok = expected_index in plan
+			all_ok = all_ok and is_ok
+			print("{} {} (expects {})\n{}\n".format("OK  " if is_ok else "FAIL", name, expected_index, plan), flush=True)
+		session.rollback()
+	return all_ok
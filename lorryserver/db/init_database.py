@@ -1,11 +1,22 @@
+import sqlalchemy
+
 def init_database(drop=False):
-    from .. import app
-    from . import models
+    from ..core import create_flask_application
+    from . import migrations, models
+
+    app = create_flask_application()
 
     with app.app_context():
         if drop:
             print("Dropping database...", flush=True)
             models.db.drop_all()
 
+        if sqlalchemy.inspect(models.db.engine).has_table(models.Package.__tablename__):
+            # An existing database might be older than the models. create_all would not add the new columns.
+            print("Migrating database...", flush=True)
+            migrations.apply_migrations()
+            return
+
         print("Initializing database...", flush=True)
         models.db.create_all()
+        migrations.stamp()
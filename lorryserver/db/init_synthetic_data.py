@@ -0,0 +1,81 @@
+import datetime
+import os
+import random
+import tempfile
+
+from lorem_text import lorem
+
+def init_synthetic_data(n_packages=1000, n_tags=200, n_users=50, dependency_depth=20, file_sizes=(2**10, 2**16, 2**20), seed=0):
+	"""Fills the database with a generated catalog that is large enough for benchmarks.
+
+	Tag popularity follows a Zipf distribution. Every package depends on some older packages.
+	Packages in the same chain depend on their predecessor, which leads to dependency paths of length dependency_depth.
+	Every package gets one to three files with sizes randomly chosen from file_sizes.
+	"""
+	from ..core import create_flask_application
+
+	with create_flask_application().app_context():
+		add_synthetic_data(n_packages, n_tags, n_users, dependency_depth, file_sizes, seed)
+
+def add_synthetic_data(n_packages, n_tags, n_users, dependency_depth, file_sizes, seed):
+	from . import models
+	session = models.db.session
+	rng = random.Random(seed)
+	# lorem_text draws from the global random generator, which has to be seeded as well to reproduce the texts.
+	random.seed(seed)
+	print("Filling database with {} synthetic packages...".format(n_packages), flush=True)
+
+	users = [models.User(name="Synthetic user {}".format(i), external_id=100000 + i, is_moderator=(i == 0)) for i in range(n_users)]
+	session.add_all(users)
+	session.commit()
+
+	tag_titles = ["synthetic-tag-{}".format(i) for i in range(n_tags)]
+	tags = models.Tag.get_or_create_all(tag_titles + ["openclonk-8", "openclonk-9", ".scenario", ".objects"])
+	tags = dict(((tag.title, tag) for tag in tags))
+	tag_weights = [1.0 / (rank + 1) for rank in range(n_tags)]
+	session.commit()
+
+	now = datetime.datetime.now(datetime.timezone.utc)
+	packages = []
+	with tempfile.TemporaryDirectory() as temporary_directory:
+		for i in range(n_packages):
+			owner = rng.choice(users)
+			long_description = lorem.paragraphs(rng.randint(0, 5)) if rng.random() < 0.8 else None
+			package = models.Package(title="Synthetic {} {}".format(lorem.words(2), i)[:64], author=owner.name,
+									 description=lorem.sentence()[:100].ljust(50, "."), long_description=long_description, owner=owner.id,
+									 creation_date=now - datetime.timedelta(days=rng.randint(0, 3650)),
+									 modification_date=now - datetime.timedelta(minutes=rng.randint(0, 525600)))
+
+			is_scenario = rng.random() < 0.6
+			package_tags = set(rng.choices(tag_titles, weights=tag_weights, k=rng.randint(1, 6)))
+			package_tags.add(".scenario" if is_scenario else ".objects")
+			package_tags.add(rng.choice(("openclonk-8", "openclonk-9")))
+			package.tags = [tags[title] for title in package_tags]
+
+			# Each chain of dependency_depth packages depends on its predecessor. Additionally, depend on random older packages.
+			dependencies = set()
+			if i % dependency_depth != 0:
+				dependencies.add(i - 1)
+			if i > 0:
+				dependencies.update((rng.randrange(i) for _ in range(rng.choice((0, 0, 1, 2)))))
+			for dependency_index in dependencies:
+				package.dependencies.append(models.PackageDependencies(packages[dependency_index]))
+
+			for file_index in range(rng.randint(1, 3)):
+				extension = "ocs" if (is_scenario and file_index == 0) else "ocd"
+				path = os.path.join(temporary_directory, "synthetic{}_{}.{}".format(i, file_index, extension))
+				with open(path, "wb") as f:
+					f.write(rng.randbytes(rng.choice(file_sizes)))
+				resource = models.Resource(package=package, owner=owner.id)
+				resource.init_from_path(path)
+				session.add(resource)
+
+			package.update_search_text()
+			package.update_rendered_long_description()
+			session.add(package)
+			packages.append(package)
+
+			if (i + 1) % 100 == 0:
+				session.commit()
+				print("{} of {} packages".format(i + 1, n_packages), flush=True)
+	session.commit()
@@ -1,10 +1,17 @@
 import datetime
+import flask
 import shutil
 import tempfile
 import os
 from lorem_text import lorem
 
 def init_test_data():
+	from ..core import create_flask_application
+
+	with create_flask_application().app_context():
+		add_test_data()
+
+def add_test_data():
 	from . import models
 	session = models.db.session
 	print("Filling database with test data...", flush=True)
@@ -50,7 +57,7 @@ def init_test_data():
 		description="Unicode test. And also maximum description length test to see whether it looks fine in the interfaces because it should. Otherwise that would suck bad",
 		owner=user2.id, modification_date=last_week))
 
-	files = [os.path.join(models.app.config.get("TEST_DATA_PATH"), file) for file in os.listdir(models.app.config.get("TEST_DATA_PATH"))]
+	files = [os.path.join(flask.current_app.config.get("TEST_DATA_PATH"), file) for file in os.listdir(flask.current_app.config.get("TEST_DATA_PATH"))]
 
 	with tempfile.TemporaryDirectory() as f:
 		for idx, file in enumerate(files):
@@ -69,5 +76,7 @@ def init_test_data():
 
 	for p in packages:
 		p.update_search_text()
+		p.update_rendered_long_description()
+		p.create_release(flask.current_app.config.get("RELEASES_KEPT_PER_PACKAGE"))
 		session.add(p)
 	session.commit()
\ No newline at end of file
@@ -0,0 +1,141 @@
+"""Versioned schema migrations for existing databases.
+
+New databases are created from the models by init_database and stamped with the latest version.
+Existing databases are brought up to date with: python3 -c "from lorryserver.db.migrations import migrate;migrate()"
+
+Every migration is plain SQL and runs in its own transaction. Version 0 is the schema before migrations existed.
+When changing the models, append a migration that makes the same change, so that both ways end up with the same schema.
+"""
+
+# (version, description, SQL)
+MIGRATIONS = [
+	(1, "Unique tag titles", """
+		-- Concurrent uploads could create the same tag twice. Keep the oldest tag of every title.
+		DELETE FROM packagetagassociation a USING tag t WHERE a.tag_id = t.id AND EXISTS (
+			SELECT 1 FROM packagetagassociation b JOIN tag u ON u.id = b.tag_id
+			WHERE b.package_id = a.package_id AND u.title = t.title AND u.id < t.id);
+		UPDATE packagetagassociation a SET tag_id = k.min_id FROM tag t, (SELECT title, min(id) AS min_id FROM tag GROUP BY title) k
+			WHERE a.tag_id = t.id AND k.title = t.title AND t.id <> k.min_id;
+		DELETE FROM tag t USING tag k WHERE k.title = t.title AND k.id < t.id;
+		CREATE UNIQUE INDEX IF NOT EXISTS ix_tag_title ON tag (title);
+	"""),
+	(2, "Pre-rendered long descriptions", """
+		ALTER TABLE package ADD COLUMN IF NOT EXISTS long_description_html TEXT;
+		ALTER TABLE package ADD COLUMN IF NOT EXISTS long_description_hash VARCHAR(40);
+	"""),
+	(3, "User version counter", """
+		ALTER TABLE "user" ADD COLUMN IF NOT EXISTS version_id INTEGER NOT NULL DEFAULT 1;
+		ALTER TABLE "user" ALTER COLUMN version_id DROP DEFAULT;
+	"""),
+	(4, "Job queue", """
+		CREATE TABLE IF NOT EXISTS job (
+			id BIGSERIAL NOT NULL,
+			kind VARCHAR(64) NOT NULL,
+			payload JSONB NOT NULL,
+			creation_date TIMESTAMP WITH TIME ZONE NOT NULL,
+			run_after TIMESTAMP WITH TIME ZONE NOT NULL,
+			attempts INTEGER NOT NULL,
+			last_error TEXT,
+			PRIMARY KEY (id)
+		);
+	"""),
+	(5, "Contents of group files", """
+		CREATE TABLE IF NOT EXISTS resourcecontent (
+			id SERIAL NOT NULL,
+			resource_id UUID NOT NULL,
+			path VARCHAR NOT NULL,
+			kind VARCHAR(16) NOT NULL,
+			identifier VARCHAR,
+			title VARCHAR,
+			engine_version VARCHAR(16),
+			PRIMARY KEY (id),
+			FOREIGN KEY(resource_id) REFERENCES resource (id) ON DELETE CASCADE
+		);
+		CREATE INDEX IF NOT EXISTS ix_resourcecontent_resource_id ON resourcecontent (resource_id);
+	"""),
+	(6, "Releases", """
+		CREATE TABLE IF NOT EXISTS release (
+			id SERIAL NOT NULL,
+			package_id UUID NOT NULL,
+			version INTEGER NOT NULL,
+			creation_date TIMESTAMP WITH TIME ZONE NOT NULL,
+			PRIMARY KEY (id),
+			UNIQUE (package_id, version),
+			FOREIGN KEY(package_id) REFERENCES package (id) ON DELETE CASCADE
+		);
+		CREATE TABLE IF NOT EXISTS releasefile (
+			id SERIAL NOT NULL,
+			release_id INTEGER NOT NULL,
+			original_filename VARCHAR NOT NULL,
+			size INTEGER,
+			md5 VARCHAR NOT NULL,
+			sha1 VARCHAR NOT NULL,
+			PRIMARY KEY (id),
+			FOREIGN KEY(release_id) REFERENCES release (id) ON DELETE CASCADE
+		);
+		CREATE INDEX IF NOT EXISTS ix_releasefile_sha1 ON releasefile (sha1);
+		CREATE INDEX IF NOT EXISTS ix_releasefile_release_id ON releasefile (release_id);
+	"""),
+	(7, "Indexes on sort keys and lookup columns", """
+		CREATE INDEX IF NOT EXISTS ix_package_modification_date ON package (modification_date);
+		CREATE INDEX IF NOT EXISTS ix_package_title ON package (title);
+		CREATE INDEX IF NOT EXISTS ix_resource_sha1 ON resource (sha1);
+		CREATE INDEX IF NOT EXISTS ix_resource_package_id ON resource (package_id);
+		CREATE INDEX IF NOT EXISTS ix_packagetagassociation_package_id ON packagetagassociation (package_id);
+		CREATE INDEX IF NOT EXISTS ix_packagedependencies_dependency_id ON packagedependencies (dependency_id);
+	"""),
+	(8, "Indexing marker of files", """
+		ALTER TABLE resource ADD COLUMN IF NOT EXISTS indexed_at TIMESTAMP WITH TIME ZONE;
+		-- Files with contents have been indexed before. The others are indexed once more.
+		UPDATE resource r SET indexed_at = now() WHERE indexed_at IS NULL
+			AND EXISTS (SELECT 1 FROM resourcecontent c WHERE c.resource_id = r.id);
+	"""),
+	(9, "Job priorities", """
+		ALTER TABLE job ADD COLUMN IF NOT EXISTS priority INTEGER NOT NULL DEFAULT 0;
+		ALTER TABLE job ALTER COLUMN priority DROP DEFAULT;
+	"""),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Serializes migrations of concurrently started instances. An arbitrary, but fixed number.
+MIGRATION_LOCK_ID = 4711
+
+def get_schema_version(connection):
+	from . import models
+
+	models.SchemaVersion.__table__.create(connection, checkfirst=True)
+	return connection.exec_driver_sql("SELECT max(version) FROM schema_version").scalar() or 0
+
+def stamp(version=LATEST_VERSION, description="Created from the models"):
+	"""Marks the database as being at the version without running migrations. Needs an application context.
+	"""
+	from . import models
+
+	with models.db.engine.begin() as connection:
+		get_schema_version(connection)
+		connection.execute(models.SchemaVersion.__table__.insert().values(version=version, description=description))
+
+def apply_migrations():
+	"""Applies all pending migrations. Needs an application context. Returns the number of applied migrations.
+	"""
+	from . import models
+
+	n_applied = 0
+	for (version, description, sql) in MIGRATIONS:
+		with models.db.engine.begin() as connection:
+			connection.exec_driver_sql("SELECT pg_advisory_xact_lock({})".format(MIGRATION_LOCK_ID))
+			if get_schema_version(connection) >= version:
+				continue
+			print("Applying migration {}: {}".format(version, description), flush=True)
+			connection.exec_driver_sql(sql)
+			connection.execute(models.SchemaVersion.__table__.insert().values(version=version, description=description))
+			n_applied += 1
+	return n_applied
+
+def migrate():
+	from ..core import create_flask_application
+
+	with create_flask_application().app_context():
+		n_applied = apply_migrations()
+		print("Applied {} migrations. The database is at version {}.".format(n_applied, LATEST_VERSION), flush=True)
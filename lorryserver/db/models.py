@@ -1,7 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
 import sqlalchemy
 from sqlalchemy.orm import backref
-from sqlalchemy.dialects.postgresql import UUID, TSVECTOR, TIMESTAMP
+from sqlalchemy.dialects.postgresql import UUID, TSVECTOR, TIMESTAMP, JSONB
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.associationproxy import association_proxy
 import pathlib
@@ -11,12 +12,30 @@ import hashlib
 import uuid
 import slugify
 import json
+import markdown
+import markupsafe
 
 from ..utils.resources import resource_manager
-from .. import core
+from .replicas import RoutingSession
 
-app = core.create_flask_application()
-db = SQLAlchemy(app)
+# Bound to the application in core.create_flask_application.
+db = SQLAlchemy(session_options=dict(class_=RoutingSession))
+
+
+def get_search_string(texts):
+	"""Returns the text that the search vector of a package is built from.
+	"""
+	return " ".join((slugify.slugify(s, separator=" ") for s in texts if s))
+
+def get_long_description_hash(text):
+	return hashlib.sha1(text.encode()).hexdigest()
+
+def render_long_description(text):
+	"""Returns the HTML of the Markdown text and the hash of the text.
+	"""
+	# Escape first, so that users can not inject their own HTML.
+	html = markdown.markdown(str(markupsafe.escape(text))) if text else ""
+	return html, get_long_description_hash(text)
 
 
 class User(db.Model):
@@ -27,6 +46,8 @@ class User(db.Model):
 	name = db.Column(db.String)
 	# Whether this user can edit other people's things.
 	is_moderator = db.Column(db.Boolean, default=False)
+	# Incremented on every change of the user. Identifies outdated cached copies of the user, see app.load_user.
+	version_id = db.Column(db.Integer, nullable=False, default=1)
 
 	@property
 	def is_authenticated(self):
@@ -56,7 +77,32 @@ class EditableResource(object):
 class Tag(db.Model):
 	__tablename__ = "tag"
 	id = db.Column(db.Integer, primary_key=True)
-	title = db.Column(db.String(32))
+	# Unique, so that concurrent uploads can not create the same tag twice.
+	title = db.Column(db.String(32), unique=True, index=True)
+
+	@staticmethod
+	def get_normalized_title(title):
+		"""Maps file extension tags to the tags of their kind. Returns None for titles that are too short.
+		"""
+		if len(title) < 2:
+			return None
+		if title in (".ocs", ".ocf"):
+			return ".scenario"
+		if title == ".ocd":
+			return ".objects"
+		return title
+
+	@classmethod
+	def get_or_create_all(cls, titles):
+		"""Returns the tag objects for all titles, inserting the missing ones.
+		Costs two queries independent of the number of tags. Does not commit the session.
+		"""
+		titles = set(titles)
+		if not titles:
+			return []
+		statement = postgresql.insert(cls).values([dict(title=title) for title in sorted(titles)])
+		db.session.execute(statement.on_conflict_do_nothing(index_elements=[cls.title]))
+		return cls.query.filter(cls.title.in_(titles)).order_by(cls.title).all()
 
 class Package(EditableResource, db.Model):
 	__tablename__ = "package"
@@ -65,14 +111,21 @@ class Package(EditableResource, db.Model):
 	description = db.Column(db.String(length=150))
 	# Longer description that could contain e.g. change notes.
 	long_description = db.Column(db.Text)
+	# Pre-rendered HTML of the long description and the SHA1 of the text it was rendered from.
+	long_description_html = db.Column(db.Text)
+	long_description_hash = db.Column(db.String(40))
 	author = db.Column(db.String)
 	search_text = db.Column(TSVECTOR)
 
 	tags = db.relationship(Tag, secondary="packagetagassociation")
 	resources = db.relationship("Resource", cascade="all,delete-orphan")
+	releases = db.relationship("Release", cascade="all,delete-orphan", order_by="Release.version", back_populates="package")
 
 	__table_args__ = (
 		db.Index('pck_text_idx', search_text, postgresql_using='gin'),
+		# Sort keys of the package list.
+		db.Index('ix_package_modification_date', 'modification_date'),
+		db.Index('ix_package_title', title),
 	)
 
 	# Immutable collection of tags that have an icon assigned.
@@ -127,8 +180,36 @@ class Package(EditableResource, db.Model):
 		return False
 
 	def update_search_text(self):
-		all_text = " ".join((slugify.slugify(s, separator=" ") for s in (self.title, self.description, self.author) + tuple((t.title for t in self.tags)) if s))
-		self.search_text = sqlalchemy.func.to_tsvector(all_text)
+		# The scenarios and definitions found in the files are searchable, too.
+		content_texts = tuple((text for r in self.resources for c in r.contents for text in (c.identifier, c.title)))
+		self.search_text = sqlalchemy.func.to_tsvector(get_search_string((self.title, self.description, self.author) + tuple((t.title for t in self.tags)) + content_texts))
+
+	def update_rendered_long_description(self):
+		"""Renders the long description's Markdown to HTML. Does nothing if the text did not change.
+		Returns whether the HTML was rendered.
+		"""
+		text = self.long_description or ""
+		if self.long_description_html is not None and self.long_description_hash == get_long_description_hash(text):
+			return False
+		self.long_description_html, self.long_description_hash = render_long_description(text)
+		return True
+
+	def create_release(self, max_releases):
+		"""Snapshots the current files as a new release, unless they are the same as in the latest release.
+		Only the newest max_releases releases are kept. Returns the SHA1s of the files of the dropped releases.
+		"""
+		files = sorted(((r.original_filename, r.sha1) for r in self.resources))
+		latest_release = self.releases[-1] if self.releases else None
+		if latest_release is not None and sorted(((f.original_filename, f.sha1) for f in latest_release.files)) == files:
+			return []
+
+		self.releases.append(Release(version=(latest_release.version + 1) if latest_release is not None else 1,
+									files=[ReleaseFile(original_filename=r.original_filename, size=r.size, sha1=r.sha1, md5=r.md5) for r in self.resources]))
+		dropped_hashes = []
+		for outdated_release in self.releases[:-max_releases]:
+			dropped_hashes.extend((f.sha1 for f in outdated_release.files))
+			self.releases.remove(outdated_release)
+		return dropped_hashes
 
 	def to_dict(self, detailed=False):
 		d = {
@@ -143,6 +224,7 @@ class Package(EditableResource, db.Model):
 		}
 
 		if detailed:
+			d["release"] = self.releases[-1].version if self.releases else None
 			d["dependencies"] = [d.dependency_id.hex for d in self.dependencies]
 			d["files"] = []
 			for f in self.resources:
@@ -162,12 +244,13 @@ class Package(EditableResource, db.Model):
 class PackageTagAssociation(db.Model):
 	__tablename__ = 'packagetagassociation'
 	tag_id = db.Column(db.Integer, db.ForeignKey(Tag.id), primary_key=True)
-	package_id = db.Column(UUID(as_uuid=True), db.ForeignKey(Package.id), primary_key=True)
+	# Lookups by tag use the primary key, which starts with tag_id.
+	package_id = db.Column(UUID(as_uuid=True), db.ForeignKey(Package.id), index=True, primary_key=True)
 
 class PackageDependencies(db.Model):
 	__tablename__ = 'packagedependencies'
 	package_id = db.Column(UUID(as_uuid=True), db.ForeignKey(Package.id), index=True, primary_key=True)
-	dependency_id = db.Column(UUID(as_uuid=True), db.ForeignKey(Package.id), primary_key=True)
+	dependency_id = db.Column(UUID(as_uuid=True), db.ForeignKey(Package.id), index=True, primary_key=True)
 
 	def __init__(self, dependency):
 		self.dependency = dependency
@@ -181,12 +264,16 @@ class PackageDependencies(db.Model):
 
 class Resource(EditableResource, db.Model):
 	__tablename__ = 'resource'
-	package_id = db.Column(UUID(as_uuid=True), db.ForeignKey(Package.id))
+	package_id = db.Column(UUID(as_uuid=True), db.ForeignKey(Package.id), index=True)
 	package = db.relationship("Package", back_populates="resources")
 	original_filename = db.Column(db.String)
 	size = db.Column(db.Integer)
 	md5 = db.Column(db.String, nullable=False)
-	sha1 = db.Column(db.String, nullable=False)
+	# Indexed for the check whether a file on the file system is still used.
+	sha1 = db.Column(db.String, nullable=False, index=True)
+	contents = db.relationship("ResourceContent", cascade="all,delete-orphan", passive_deletes=True)
+	# Set by the job worker once the contents were read, also when the file is not a group file or contains nothing.
+	indexed_at = db.Column(db.TIMESTAMP(timezone=True))
 	
 	def init_from_file_storage(self, filename, storage):
 		self.original_filename = filename
@@ -233,6 +320,78 @@ class Resource(EditableResource, db.Model):
 			size /= 1024.0
 		return f"{size:.{decimal_places}f}{unit}"
 
+class ResourceContent(db.Model):
+	"""A scenario, folder or object definition inside an uploaded group file. Filled in by the job worker.
+	"""
+	__tablename__ = 'resourcecontent'
+	id = db.Column(db.Integer, primary_key=True)
+	resource_id = db.Column(UUID(as_uuid=True), db.ForeignKey(Resource.id, ondelete="CASCADE"), index=True, nullable=False)
+	# Path inside the group file, e.g. "Scenario.ocs/Objects.ocd".
+	path = db.Column(db.String, nullable=False)
+	kind = db.Column(db.String(16), nullable=False)
+	# The ID of object definitions.
+	identifier = db.Column(db.String)
+	title = db.Column(db.String)
+	# The required engine version, e.g. "8.0".
+	engine_version = db.Column(db.String(16))
+
+class Release(db.Model):
+	"""An immutable snapshot of a package's files, created whenever an upload changes them.
+	The files stay on the file system while a release refers to them, so that clients can update from them with deltas.
+	"""
+	__tablename__ = 'release'
+	id = db.Column(db.Integer, primary_key=True)
+	package_id = db.Column(UUID(as_uuid=True), db.ForeignKey(Package.id, ondelete="CASCADE"), nullable=False)
+	package = db.relationship(Package, back_populates="releases")
+	# Counts up from 1 for every package.
+	version = db.Column(db.Integer, nullable=False)
+	creation_date = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.datetime.now(datetime.timezone.utc))
+	files = db.relationship("ReleaseFile", cascade="all,delete-orphan", order_by="ReleaseFile.original_filename")
 
+	__table_args__ = (
+		db.UniqueConstraint(package_id, version),
+	)
 
+	def to_dict(self):
+		return {
+			"version": self.version,
+			"createdAt": self.creation_date.isoformat(),
+			"files": [{
+					"filename": f.original_filename,
+					"length": f.size,
+					"sha1": f.sha1,
+					"md5": f.md5,
+				} for f in self.files],
+		}
 
+class ReleaseFile(db.Model):
+	__tablename__ = 'releasefile'
+	id = db.Column(db.Integer, primary_key=True)
+	release_id = db.Column(db.Integer, db.ForeignKey(Release.id, ondelete="CASCADE"), index=True, nullable=False)
+	original_filename = db.Column(db.String, nullable=False)
+	size = db.Column(db.Integer)
+	md5 = db.Column(db.String, nullable=False)
+	sha1 = db.Column(db.String, nullable=False, index=True)
+
+class SchemaVersion(db.Model):
+	"""The migrations that were applied to the database, see migrations.py.
+	"""
+	__tablename__ = 'schema_version'
+	version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+	description = db.Column(db.String)
+	applied_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.datetime.now(datetime.timezone.utc))
+
+class Job(db.Model):
+	"""Work for the background worker, see jobs.py.
+	"""
+	__tablename__ = 'job'
+	id = db.Column(db.BigInteger, primary_key=True)
+	kind = db.Column(db.String(64), nullable=False)
+	payload = db.Column(JSONB, nullable=False)
+	creation_date = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.datetime.now(datetime.timezone.utc))
+	# Failed jobs are retried later.
+	run_after = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.datetime.now(datetime.timezone.utc))
+	attempts = db.Column(db.Integer, nullable=False, default=0)
+	last_error = db.Column(db.Text)
+	# Due jobs with a higher priority are run first.
+	priority = db.Column(db.Integer, nullable=False, default=0)
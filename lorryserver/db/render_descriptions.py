@@ -0,0 +1,19 @@
+def render_descriptions(batch_size=100):
+	"""Fills the pre-rendered long description HTML for all packages where it is missing or outdated.
+	"""
+	from ..core import create_flask_application
+	from . import models
+
+	app = create_flask_application()
+
+	with app.app_context():
+		print("Rendering long descriptions...", flush=True)
+		n_rendered = 0
+		packages = models.Package.query.order_by(models.Package.id).all()
+		for idx, package in enumerate(packages):
+			if package.update_rendered_long_description():
+				n_rendered += 1
+			if (idx + 1) % batch_size == 0:
+				models.db.session.commit()
+		models.db.session.commit()
+		print("Rendered {} of {} descriptions.".format(n_rendered, len(packages)), flush=True)
@@ -0,0 +1,81 @@
+"""Routes the queries of read-only views to read replicas.
+
+Views decorated with read_only use a randomly chosen replica from SQLALCHEMY_REPLICA_URIS for the whole request.
+Everything else, including all writes, goes to SQLALCHEMY_DATABASE_URI.
+A user who just saved something reads from the primary for REPLICA_STICKINESS seconds, so they see their own changes
+even if the replicas lag behind. Data that is shared between users, such as the catalog read model, is loaded from the
+primary, as a lagging replica would otherwise show the old state to everyone, including the user who saved.
+"""
+import contextlib
+import functools
+import random
+import time
+
+import flask
+import flask_sqlalchemy.session
+
+REPLICA_BIND_KEY_PREFIX = "replica_"
+PRIMARY_UNTIL_SESSION_KEY = "primary_until"
+
+def add_replica_binds(config):
+	"""Adds the replicas to SQLALCHEMY_BINDS, so that Flask-SQLAlchemy creates their engines.
+	"""
+	binds = dict(config.get("SQLALCHEMY_BINDS") or {})
+	for (index, uri) in enumerate(config.get("SQLALCHEMY_REPLICA_URIS") or ()):
+		binds[REPLICA_BIND_KEY_PREFIX + str(index)] = uri
+	config["SQLALCHEMY_BINDS"] = binds
+
+def read_only(view):
+	"""Lets the view read from a replica. The view must not write to the database.
+	"""
+	@functools.wraps(view)
+	def read_only_view(*args, **kwargs):
+		flask.g.database_read_only = True
+		return view(*args, **kwargs)
+	return read_only_view
+
+def stick_to_primary():
+	"""Makes the current user read from the primary for a while. Call after committing the user's changes.
+	"""
+	flask.session[PRIMARY_UNTIL_SESSION_KEY] = time.time() + flask.current_app.config.get("REPLICA_STICKINESS")
+
+def is_sticky():
+	"""Returns whether the current user has to read from the primary to see their own changes.
+	"""
+	return flask.has_request_context() and flask.session.get(PRIMARY_UNTIL_SESSION_KEY, 0) >= time.time()
+
+@contextlib.contextmanager
+def primary():
+	"""Sends the queries inside the block to the primary, also in read-only views.
+	"""
+	if not flask.has_request_context():
+		yield
+		return
+	was_read_only = flask.g.get("database_read_only", False)
+	flask.g.database_read_only = False
+	try:
+		yield
+	finally:
+		flask.g.database_read_only = was_read_only
+
+def get_replica_engine(engines):
+	if not flask.has_request_context() or not flask.g.get("database_read_only"):
+		return None
+	# The replica is chosen once per request, so that all queries of a request see the same state.
+	if "replica_bind_key" not in flask.g:
+		replica_bind_keys = [key for key in engines if key is not None and key.startswith(REPLICA_BIND_KEY_PREFIX)]
+		if replica_bind_keys and not is_sticky():
+			flask.g.replica_bind_key = random.choice(replica_bind_keys)
+		else:
+			flask.g.replica_bind_key = None
+	if flask.g.replica_bind_key is None:
+		return None
+	return engines[flask.g.replica_bind_key]
+
+class RoutingSession(flask_sqlalchemy.session.Session):
+	def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+		if bind is None:
+			engine = get_replica_engine(self._db.engines)
+			if engine is not None:
+				return engine
+		return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
@@ -1,10 +1,15 @@
+import flask
 from wtforms import BooleanField, StringField, validators, PasswordField, MultipleFileField, SelectMultipleField, ValidationError
 from wtforms.widgets import TextArea, ListWidget, CheckboxInput
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileAllowed
 
-from . import core
-app = core.create_flask_application()
+class AllowedFileExtensions():
+	"""Iterates over the allowed file extensions of the current application.
+	Lets validators be defined before any application exists.
+	"""
+	def __iter__(self):
+		return iter(flask.current_app.config.get("ALLOWED_FILE_EXTENSIONS"))
 
 class RegistrationForm(FlaskForm):
 	username = StringField('Username', [validators.Length(min=4, max=25)])
@@ -33,7 +38,7 @@ class UploadForm(FlaskForm):
 	tags = StringField("Tags")
 	dependencies = StringField("Dependencies")
 
-	files = MultipleFileField("Upload file(s)", [FileAllowed(app.config.get("ALLOWED_FILE_EXTENSIONS"))], render_kw={'multiple': True})
+	files = MultipleFileField("Upload file(s)", [FileAllowed(AllowedFileExtensions())], render_kw={'multiple': True})
 	remove_existing_files = MultiCheckboxField("Delete existing files", choices=[])
 
 	def __init__(self, existing_package=None, **kwargs):
@@ -0,0 +1,310 @@
+"""Durable queue for work that can be done after a request was committed.
+
+Jobs are rows in the job table. They are added to the session of the request and thus only become visible when the
+request's transaction is committed. Any number of workers can process them concurrently, as every worker claims
+jobs with SELECT ... FOR UPDATE SKIP LOCKED. Due jobs are claimed by priority and then in order. A claimed job is
+leased for JOB_LEASE_TIME seconds, during which other workers skip it, so the row lock is not held while the job runs.
+
+Start a worker with: python3 -m lorryserver.jobs
+"""
+import concurrent.futures
+import datetime
+import multiprocessing
+import signal
+import threading
+import traceback
+import uuid
+
+import flask
+import sqlalchemy
+
+from . import publisher
+from .core import cache
+from .db import models, catalog
+from .utils import c4group, resources
+
+job_handlers = dict()
+job_priorities = dict()
+# Functions that are called once the transaction of the current job was committed.
+after_commit_callbacks = []
+# The attempt (counting from 1) and the maximum number of attempts of the current job.
+current_attempt = dict(attempt=1, max_attempts=1)
+
+def job_handler(kind, priority=0):
+	"""Registers the decorated function as the handler of a job kind. It is called with the job's payload as keyword arguments.
+	Jobs of kinds with a lower priority only run when no other jobs are due.
+	"""
+	def register(function):
+		job_handlers[kind] = function
+		job_priorities[kind] = priority
+		return function
+	return register
+
+def enqueue(kind, **payload):
+	"""Adds a job to the current session. Does not commit the session.
+	"""
+	assert kind in job_handlers
+	models.db.session.add(models.Job(kind=kind, payload=payload, priority=job_priorities[kind]))
+
+def enqueue_once(kind, **payload):
+	"""Like enqueue, but does nothing if the same job is already waiting. Returns whether the job was added.
+	Jobs that failed too often do not count, as they are never run again.
+	Two concurrent calls can still add the job twice, so the job has to tolerate that.
+	"""
+	max_attempts = flask.current_app.config.get("JOB_MAX_ATTEMPTS")
+	if models.Job.query.filter(models.Job.kind == kind, models.Job.payload == payload, models.Job.attempts < max_attempts).first() is not None:
+		return False
+	enqueue(kind, **payload)
+	return True
+
+def is_last_attempt():
+	"""Returns whether the current job is not retried if it fails.
+	"""
+	return current_attempt["attempt"] >= current_attempt["max_attempts"]
+
+def call_after_commit(function, *args):
+	"""Calls the function after the current job was committed, e.g. to invalidate caches only once other workers can see the changes.
+	"""
+	after_commit_callbacks.append((function, args))
+
+@job_handler("remove_resources")
+def remove_resources(hashes):
+	"""Removes the files of the hashes from the file system, unless another resource or a release still uses them.
+	"""
+	hashes = set(hashes)
+	used_hashes = models.db.session.query(models.Resource.sha1).filter(models.Resource.sha1.in_(hashes)) \
+		.union(models.db.session.query(models.ReleaseFile.sha1).filter(models.ReleaseFile.sha1.in_(hashes))).all()
+	for hash in hashes - set((sha1 for (sha1,) in used_hashes)):
+		resources.resource_manager.remove_resource(hash)
+
+@job_handler("remove_orphaned_tags")
+def remove_orphaned_tags(tag_ids):
+	if not tag_ids:
+		return
+	is_still_used = sqlalchemy.exists().where(models.PackageTagAssociation.tag_id == models.Tag.id)
+	statement = sqlalchemy.delete(models.Tag).where(models.Tag.id.in_(tag_ids), ~is_still_used)
+	models.db.session.execute(statement.execution_options(synchronize_session=False))
+
+@job_handler("update_search_text")
+def update_search_text(package_id):
+	package = models.db.session.get(models.Package, uuid.UUID(package_id))
+	if package is not None:
+		package.update_search_text()
+
+@job_handler("publish_static_pages")
+def publish_static_pages(package_ids):
+	publisher.publish_static_pages(package_ids)
+
+def enqueue_static_pages(package_ids):
+	"""Enqueues the re-rendering of the static pages of the packages and of the package list, if static pages are enabled.
+	"""
+	if flask.current_app.config.get("STATIC_PAGES_ENABLED"):
+		enqueue("publish_static_pages", package_ids=sorted((package_id.hex for package_id in package_ids)))
+
+process_pool = None
+
+def get_process_pool():
+	"""Returns the pool for CPU-heavy jobs. It also keeps the parsing of uploaded files out of the worker process.
+	"""
+	global process_pool
+	if process_pool is None:
+		process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=flask.current_app.config.get("JOB_PROCESS_POOL_SIZE"),
+																mp_context=multiprocessing.get_context("spawn"))
+	return process_pool
+
+def kill_process_pool():
+	"""Kills the processes of the pool, e.g. because one is stuck. The next call to get_process_pool creates a new pool.
+	"""
+	global process_pool
+	if process_pool is None:
+		return
+	pool, process_pool = process_pool, None
+	# ProcessPoolExecutor has no public way to stop a running task.
+	for process in list((pool._processes or dict()).values()):
+		process.kill()
+	pool.shutdown(wait=False, cancel_futures=True)
+
+def run_in_process_pool(timeout, function, *args):
+	"""Returns the result of the function, which is run in the process pool.
+	Commits the session first, so that no transaction stays open while waiting. A task that exceeds the timeout is killed.
+	"""
+	future = get_process_pool().submit(function, *args)
+	models.db.session.commit()
+	try:
+		return future.result(timeout=timeout)
+	except concurrent.futures.TimeoutError:
+		kill_process_pool()
+		raise
+	except concurrent.futures.process.BrokenProcessPool:
+		kill_process_pool()
+		raise
+
+@job_handler("index_resource_contents")
+def index_resource_contents(resource_id):
+	"""Stores the scenarios and definitions inside an uploaded group file.
+	Tags the package with the required engine version and makes the contents searchable.
+	"""
+	from . import app as views
+
+	resource = models.db.session.get(models.Resource, uuid.UUID(resource_id))
+	if resource is None:
+		return
+
+	config = flask.current_app.config
+	path = str(resources.resource_manager.get_resource_path(resource.sha1))
+	try:
+		contents = run_in_process_pool(config.get("GROUP_INDEX_TIMEOUT"), c4group.read_group_file_contents,
+										path, resource.original_filename, config.get("GROUP_INDEX_MAX_SIZE"))
+	except c4group.C4GroupError:
+		# Not a valid group file. Retrying would not help.
+		contents = []
+	# Might have been removed while the pool was working.
+	resource = models.db.session.get(models.Resource, uuid.UUID(resource_id))
+	if resource is None:
+		return
+	resource.contents = [models.ResourceContent(**content) for content in contents]
+	resource.indexed_at = datetime.datetime.now(datetime.timezone.utc)
+
+	package = resource.package
+	if package is None:
+		return
+	major_versions = [int(c["engine_version"].split(".")[0]) for c in contents if c["engine_version"]]
+	if major_versions:
+		version_tag = "openclonk-{}".format(max(major_versions))
+		if version_tag not in (t.title for t in package.tags):
+			package.tags.extend(models.Tag.get_or_create_all([version_tag]))
+			# The modification date is the user's, so the cached pages that show the tags are invalidated directly.
+			call_after_commit(catalog.bump_generation, cache)
+			call_after_commit(cache.delete_many, *views.get_package_cache_keys(package))
+			enqueue_static_pages([package.id])
+	package.update_search_text()
+
+@job_handler("compress_resource")
+def compress_resource(sha1):
+	"""Creates the precompressed variants that download_file serves to clients that accept them.
+	"""
+	path = resources.resource_manager.get_resource_path(sha1)
+	if not path.exists():
+		# Removed in the meantime.
+		return
+	config = flask.current_app.config
+	run_in_process_pool(config.get("RESOURCE_COMPRESSION_TIMEOUT"), resources.create_compressed_variants, str(path), config.get("RESOURCE_COMPRESSION_MIN_SAVING"))
+
+# Anonymous clients can request deltas, so they must not delay the jobs of uploads.
+@job_handler("create_delta", priority=-1)
+def create_delta(old_sha1, new_sha1):
+	"""Creates the patch that the delta download endpoint serves.
+	"""
+	manager = resources.resource_manager
+	old_path, new_path = manager.get_resource_path(old_sha1), manager.get_resource_path(new_sha1)
+	delta_path = manager.get_delta_path(old_sha1, new_sha1)
+	if delta_path.exists():
+		return
+	config = flask.current_app.config
+	# bsdiff needs about 17 times the size of the files in memory.
+	max_size = config.get("DELTA_MAX_FILE_SIZE")
+	if not old_path.exists() or not new_path.exists() or old_path.stat().st_size > max_size or new_path.stat().st_size > max_size:
+		resources.mark_delta_unavailable(delta_path)
+		return
+	try:
+		run_in_process_pool(config.get("DELTA_TIMEOUT"), resources.create_delta, str(old_path), str(new_path), str(delta_path), config.get("DELTA_MAX_RATIO"))
+	except Exception:
+		if not is_last_attempt():
+			raise
+		# Clients stop waiting for the delta and download the whole file.
+		traceback.print_exc()
+		resources.mark_delta_unavailable(delta_path)
+
+def index_all_resources():
+	"""Enqueues the indexing of all files that have not been indexed yet, e.g. the ones uploaded before indexing existed.
+	"""
+	from .core import create_flask_application
+
+	with create_flask_application().app_context():
+		resource_ids = models.db.session.query(models.Resource.id).filter(models.Resource.indexed_at.is_(None)).all()
+		for (resource_id,) in resource_ids:
+			enqueue("index_resource_contents", resource_id=resource_id.hex)
+		models.db.session.commit()
+		print("Enqueued {} files for indexing.".format(len(resource_ids)), flush=True)
+
+def compress_all_resources():
+	"""Enqueues the compression of every stored file, e.g. the ones uploaded before compression existed.
+	Files whose variants exist already are not compressed again by the job.
+	"""
+	from .core import create_flask_application
+
+	with create_flask_application().app_context():
+		sha1s = models.db.session.execute(sqlalchemy.union(
+			sqlalchemy.select(models.Resource.sha1), sqlalchemy.select(models.ReleaseFile.sha1))).scalars().all()
+		n_enqueued = 0
+		for sha1 in sha1s:
+			if enqueue_once("compress_resource", sha1=sha1):
+				n_enqueued += 1
+		models.db.session.commit()
+		print("Enqueued {} files for compression.".format(n_enqueued), flush=True)
+
+def claim_job(max_attempts):
+	"""Locks and returns the oldest of the due jobs with the highest priority, or None. The lock is held until the transaction ends.
+	"""
+	now = datetime.datetime.now(datetime.timezone.utc)
+	return models.Job.query.filter(models.Job.run_after <= now, models.Job.attempts < max_attempts) \
+		.order_by(models.Job.priority.desc(), models.Job.id).limit(1).with_for_update(skip_locked=True).first()
+
+def run_job(job):
+	job_handlers[job.kind](**job.payload)
+
+def process_next_job(max_attempts=5, retry_delay=60, lease_time=1800):
+	"""Runs the next job in its own transaction. Returns False if there was no job to run.
+	"""
+	session = models.db.session
+	job = claim_job(max_attempts)
+	if job is None:
+		session.rollback()
+		return False
+
+	# The attempt is counted when the job is leased, so that a job that kills its worker is not retried forever.
+	job_id, attempts = job.id, job.attempts
+	job.attempts = attempts + 1
+	current_attempt.update(attempt=attempts + 1, max_attempts=max_attempts)
+	job.run_after = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=lease_time)
+	session.commit()
+
+	after_commit_callbacks.clear()
+	try:
+		run_job(job)
+		session.delete(job)
+		session.commit()
+		for (function, args) in after_commit_callbacks:
+			function(*args)
+	except Exception:
+		session.rollback()
+		# Failed jobs are retried later with an increasing delay. After max_attempts they are kept for inspection.
+		job = session.get(models.Job, job_id)
+		if job is not None:
+			job.last_error = traceback.format_exc()
+			job.run_after = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=retry_delay * 2 ** attempts)
+			session.commit()
+		traceback.print_exc()
+	return True
+
+def run_worker():
+	"""Processes jobs until the process receives SIGTERM or SIGINT.
+	"""
+	from .core import create_flask_application
+
+	app = create_flask_application()
+	stopped = threading.Event()
+	for signal_number in (signal.SIGTERM, signal.SIGINT):
+		signal.signal(signal_number, lambda *args: stopped.set())
+
+	print("Job worker started.", flush=True)
+	with app.app_context():
+		max_attempts, retry_delay = app.config.get("JOB_MAX_ATTEMPTS"), app.config.get("JOB_RETRY_DELAY")
+		lease_time, poll_interval = app.config.get("JOB_LEASE_TIME"), app.config.get("JOB_POLL_INTERVAL")
+		while not stopped.is_set():
+			if not process_next_job(max_attempts, retry_delay, lease_time):
+				stopped.wait(poll_interval)
+			models.db.session.remove()
+
+if __name__ == "__main__":
+	run_worker()
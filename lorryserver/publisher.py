@@ -0,0 +1,132 @@
+"""Pre-renders the pages that anonymous visitors see into STATIC_PAGES_PATH, so that the front proxy can serve them.
+
+Layout of the directory:
+	index.html            the first page of the default package list (/)
+	index-<skip>.html     the following pages (/?skip=<skip>&sort=-updatedAt&limit=50)
+	uploads/<id>.html     the package details pages (/uploads/<id>)
+
+The job worker re-renders the pages that an upload affects. Publish everything with:
+python3 -c "from lorryserver.publisher import publish_all_static_pages;publish_all_static_pages()"
+"""
+import contextlib
+import os
+import pathlib
+import uuid
+
+import flask
+import flask_caching.jinja2ext
+
+from .core import cache
+from .db import models
+
+# The arguments of the "Next" links of the default package list.
+INDEX_PAGE_SIZE = 50
+INDEX_SORT_STRING = "-updatedAt"
+
+def get_index_page_path(base_path, skip):
+	return base_path / ("index.html" if skip == 0 else "index-{}.html".format(skip))
+
+def get_package_page_path(base_path, package_id):
+	return base_path / "uploads" / "{}.html".format(package_id.hex)
+
+class FreshFragmentCache():
+	"""Wraps the cache that is used by {% cache %} blocks in templates so that every block is rendered again.
+	The cached fragments might miss changes that do not set the modification date, but the pages never expire.
+	The fresh fragments replace the cached ones.
+	"""
+	def __init__(self, cache):
+		self.cache = cache
+
+	def __getattr__(self, name):
+		return getattr(self.cache, name)
+
+	def get(self, key):
+		return None
+
+@contextlib.contextmanager
+def fresh_fragments(app):
+	"""Renders the {% cache %} blocks of the templates inside the block from the database.
+	"""
+	fragment_cache = getattr(app.jinja_env, flask_caching.jinja2ext.JINJA_CACHE_ATTR_NAME, None)
+	if fragment_cache is None:
+		yield
+		return
+	setattr(app.jinja_env, flask_caching.jinja2ext.JINJA_CACHE_ATTR_NAME, FreshFragmentCache(fragment_cache))
+	try:
+		yield
+	finally:
+		setattr(app.jinja_env, flask_caching.jinja2ext.JINJA_CACHE_ATTR_NAME, fragment_cache)
+
+def write_page(path, html):
+	"""Replaces the page atomically, so that the proxy never serves a partially written file.
+	"""
+	path.parent.mkdir(parents=True, exist_ok=True)
+	# Unique per process, as two workers might publish the same page at once.
+	temporary_path = path.with_name("{}.{}.tmp".format(path.name, os.getpid()))
+	temporary_path.write_text(html, encoding="utf-8")
+	os.replace(temporary_path, path)
+
+def remove_page(path):
+	try:
+		os.remove(path)
+	except FileNotFoundError:
+		pass
+
+def publish_index_pages(app, base_path):
+	"""Renders the first STATIC_PAGES_INDEX_PAGES pages of the default package list and removes pages that no longer exist.
+	"""
+	from . import app as views
+
+	# The memoized package lists might not contain the latest upload yet.
+	cache.delete_memoized(views.query_all_package_ids)
+	n_pages = min(app.config.get("STATIC_PAGES_INDEX_PAGES"), max(1, -(-models.Package.query.count() // INDEX_PAGE_SIZE)))
+	for page_index in range(app.config.get("STATIC_PAGES_INDEX_PAGES")):
+		skip = page_index * INDEX_PAGE_SIZE
+		path = get_index_page_path(base_path, skip)
+		if page_index >= n_pages:
+			remove_page(path)
+			continue
+		query_string = dict(skip=skip, sort=INDEX_SORT_STRING, limit=INDEX_PAGE_SIZE) if skip > 0 else None
+		with app.test_request_context("/", query_string=query_string), fresh_fragments(app):
+			write_page(path, views.render_index_page())
+
+def publish_package_pages(app, base_path, package_ids):
+	"""Renders the details pages of the packages. The pages of packages that do not exist anymore are removed.
+	"""
+	packages = dict(((package.id, package) for package in models.Package.query.filter(models.Package.id.in_(package_ids)).all()))
+	for package_id in package_ids:
+		path = get_package_page_path(base_path, package_id)
+		package = packages.get(package_id)
+		if package is None:
+			remove_page(path)
+			continue
+		with app.test_request_context("/uploads/" + package_id.hex), fresh_fragments(app):
+			write_page(path, flask.render_template("package_details.html", package=package))
+
+def publish_static_pages(package_ids):
+	"""Re-renders the package list and the details pages of the packages. Needs an application context.
+	"""
+	app = flask.current_app
+	base_path = pathlib.Path(app.config.get("STATIC_PAGES_PATH"))
+	publish_package_pages(app, base_path, [uuid.UUID(package_id) for package_id in package_ids])
+	publish_index_pages(app, base_path)
+
+def publish_all_static_pages(batch_size=100):
+	"""Renders all pages and removes the pages of packages that do not exist anymore.
+	"""
+	from .core import create_flask_application
+
+	app = create_flask_application()
+	with app.app_context():
+		base_path = pathlib.Path(app.config.get("STATIC_PAGES_PATH"))
+		package_ids = [package_id for (package_id,) in models.db.session.query(models.Package.id).order_by(models.Package.id).all()]
+		for start in range(0, len(package_ids), batch_size):
+			publish_package_pages(app, base_path, package_ids[start:start + batch_size])
+			# Keeps the memory of the session bounded.
+			models.db.session.remove()
+		existing_pages = set((get_package_page_path(base_path, package_id) for package_id in package_ids))
+		for path in (base_path / "uploads").glob("*.html"):
+			if path not in existing_pages:
+				remove_page(path)
+		publish_index_pages(app, base_path)
+		print("Published {} package pages.".format(len(package_ids)), flush=True)
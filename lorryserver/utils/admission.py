@@ -0,0 +1,160 @@
+"""Admission control for endpoints that a single client can make expensive.
+
+Every client has a token bucket per IP and, if logged in, per user. Requests take tokens depending on their cost and
+are rejected with 429 if a bucket runs empty. Additionally, the number of concurrent requests per endpoint class is
+capped. Requests beyond the cap are rejected with 503. Both responses carry Retry-After.
+
+With ADMISSION_STORAGE = "process", the buckets and the concurrency cap are kept in every worker process, so the cap only
+has an effect with threaded workers. With "cache", they are shared between all workers through the cache, e.g. Redis.
+"""
+import functools
+import math
+import threading
+import time
+import uuid
+
+import flask
+import flask_login
+import werkzeug.exceptions
+
+from ..core import cache
+from .metrics import metrics
+
+def take_from_bucket(state, cost, rate, burst, now):
+	"""Refills the bucket state (tokens, time) and takes cost tokens if there are enough.
+	Returns the new state and the seconds until the request could be admitted, which is 0 if it was.
+	"""
+	tokens, last_update = state if state is not None else (burst, now)
+	tokens = min(burst, tokens + (now - last_update) * rate)
+	# More expensive requests than the bucket can hold are admitted when it is full.
+	cost = min(cost, burst)
+	if tokens >= cost:
+		return (tokens - cost, now), 0.0
+	return (tokens, now), (cost - tokens) / rate
+
+def take_from_buckets(states, buckets, cost, now):
+	"""Takes cost tokens from all buckets, given as (key, rate, burst) with their states, or from none of them.
+	Returns the new states and the seconds until the request could be admitted, which is 0 if it was.
+	"""
+	new_states, waits = zip(*(take_from_bucket(state, cost, rate, burst, now) for (state, (_, rate, burst)) in zip(states, buckets)))
+	wait = max(waits)
+	if wait > 0:
+		# A bucket that does not admit the request must not make the others pay for it.
+		return states, wait
+	return new_states, 0.0
+
+class ProcessBucketStore():
+	"""Token buckets in the memory of the worker process.
+	"""
+	max_buckets = 100000
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.buckets = dict()
+
+	def take(self, buckets, cost):
+		now = time.monotonic()
+		with self.lock:
+			states, wait = take_from_buckets([self.buckets.get(key) for (key, _, _) in buckets], buckets, cost, now)
+			for ((key, _, _), state) in zip(buckets, states):
+				if state is not None:
+					self.buckets[key] = state
+			if len(self.buckets) > self.max_buckets:
+				# Buckets that were refilled completely by now are the same as new ones.
+				refill_time = max((burst / rate for (_, rate, burst) in buckets))
+				self.buckets = dict(((k, (tokens, last_update)) for (k, (tokens, last_update)) in self.buckets.items()
+									if last_update + refill_time > now))
+		return wait
+
+class CacheBucketStore():
+	"""Token buckets in the application's cache, which is shared between the workers if the cache is, e.g., Redis.
+	Reading and writing a bucket is not atomic, so concurrent requests of one client might take the same tokens.
+	"""
+	def take(self, buckets, cost):
+		now = time.time()
+		cache_keys = ["admission_bucket_" + key for (key, _, _) in buckets]
+		states, wait = take_from_buckets(cache.get_many(*cache_keys), buckets, cost, now)
+		if wait == 0:
+			for (cache_key, state, (_, rate, burst)) in zip(cache_keys, states, buckets):
+				cache.set(cache_key, state, timeout=math.ceil(burst / rate) + 1)
+		return wait
+
+bucket_stores = dict(process=ProcessBucketStore(), cache=CacheBucketStore())
+
+class ProcessConcurrencyLimiter():
+	"""Caps the concurrent requests of the worker process with a semaphore per endpoint class.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.semaphores = dict()
+
+	def acquire(self, endpoint_class, cap, timeout):
+		with self.lock:
+			semaphore = self.semaphores.get(endpoint_class)
+			if semaphore is None:
+				semaphore = self.semaphores[endpoint_class] = threading.BoundedSemaphore(cap)
+		return semaphore if semaphore.acquire(blocking=False) else None
+
+	def release(self, semaphore):
+		semaphore.release()
+
+class CacheConcurrencyLimiter():
+	"""Caps the concurrent requests of all workers with cap slots per endpoint class in the cache.
+	A request takes a free slot with cache.add, which is atomic with Redis. Slots expire after the timeout,
+	so that the slots of a worker that died are freed again.
+	"""
+	def acquire(self, endpoint_class, cap, timeout):
+		token = uuid.uuid4().hex
+		for index in range(cap):
+			slot_key = "admission_slot_{}_{}".format(endpoint_class, index)
+			if cache.add(slot_key, token, timeout=timeout):
+				return (slot_key, token)
+		return None
+
+	def release(self, slot):
+		slot_key, token = slot
+		# The slot might have expired and been taken by another request in the meantime.
+		if cache.get(slot_key) == token:
+			cache.delete(slot_key)
+
+concurrency_limiters = dict(process=ProcessConcurrencyLimiter(), cache=CacheConcurrencyLimiter())
+
+def get_client_buckets(config):
+	"""Returns (key, rate, burst) of the buckets of the current client.
+	"""
+	buckets = [("ip_{}".format(flask.request.remote_addr), *config.get("ADMISSION_IP_BUCKET"))]
+	user = flask_login.current_user
+	if user.is_authenticated:
+		buckets.append(("user_{}".format(user.id), *config.get("ADMISSION_USER_BUCKET")))
+	return buckets
+
+def reject(endpoint_class, reason, exception_class, retry_after):
+	metrics.increment("lorry_admission_rejections_total", (("class", endpoint_class), ("reason", reason)))
+	raise exception_class(retry_after=max(1, math.ceil(retry_after)))
+
+def admission_controlled(endpoint_class, get_cost=lambda: 1):
+	"""Limits the decorated view by the client's token buckets and the concurrency cap of the endpoint class.
+	get_cost is called in the request context and returns the number of tokens that the request takes.
+	"""
+	def decorator(view):
+		@functools.wraps(view)
+		def controlled_view(*args, **kwargs):
+			config = flask.current_app.config
+			if not config.get("ADMISSION_CONTROL_ENABLED"):
+				return view(*args, **kwargs)
+
+			storage = config.get("ADMISSION_STORAGE")
+			wait = bucket_stores[storage].take(get_client_buckets(config), get_cost())
+			if wait > 0:
+				reject(endpoint_class, "rate", werkzeug.exceptions.TooManyRequests, wait)
+
+			limiter = concurrency_limiters[storage]
+			slot = limiter.acquire(endpoint_class, config.get("ADMISSION_CONCURRENCY")[endpoint_class], config.get("ADMISSION_CONCURRENCY_TIMEOUT"))
+			if slot is None:
+				reject(endpoint_class, "concurrency", werkzeug.exceptions.ServiceUnavailable, config.get("ADMISSION_RETRY_AFTER"))
+			try:
+				return view(*args, **kwargs)
+			finally:
+				limiter.release(slot)
+		return controlled_view
+	return decorator
@@ -0,0 +1,159 @@
+"""Reader for OpenClonk's group file format (.ocs, .ocf, .ocd, ...).
+
+A group file is gzip-compressed, with the first two bytes of the gzip header replaced by 0x1e 0x8c.
+The decompressed data starts with a scrambled header, followed by a table of entries and the entries' data.
+Entries that are groups themselves are stored uncompressed, but otherwise in the same format.
+"""
+import configparser
+import gzip
+import io
+import struct
+import zlib
+
+GROUP_MAGIC = b"\x1e\x8c"
+GZIP_MAGIC = b"\x1f\x8b"
+GROUP_ID = b"RedWolf Design GROUP"
+
+# char id[28]; int Ver1, Ver2, Entries; char reserved[164];
+HEADER_FORMAT = struct.Struct("<28siii164s")
+# char FileName[260]; int32 Packed, ChildGroup, Size, reserved1, Offset, reserved2; char reserved3;
+# uint32 reserved4; char Executable; BYTE fbuf[26];
+ENTRY_FORMAT = struct.Struct("<260siiiiiicIc26s")
+
+GROUP_EXTENSIONS = (".ocs", ".ocf", ".ocd", ".ocg", ".ocp")
+MAX_NESTING_DEPTH = 16
+MAX_VERSION_DIGITS = 6
+
+class C4GroupError(Exception):
+	pass
+
+def unscramble(data):
+	"""Undoes OpenClonk's MemScramble, which is its own inverse: swaps every first and third byte of three and XORs with 237.
+	"""
+	data = bytearray(data)
+	for i in range(0, len(data) - 2, 3):
+		data[i], data[i + 2] = data[i + 2], data[i]
+	return bytes(b ^ 237 for b in data)
+
+def decompress_group_file(path, max_size):
+	with open(path, "rb") as f:
+		magic = f.read(2)
+		if magic not in (GROUP_MAGIC, GZIP_MAGIC):
+			raise C4GroupError("Not a group file.")
+		stream = io.BytesIO(GZIP_MAGIC + f.read())
+	try:
+		with gzip.GzipFile(fileobj=stream) as decompressed:
+			data = decompressed.read(max_size + 1)
+	except (OSError, EOFError, zlib.error) as e:
+		raise C4GroupError("Invalid compression: {}".format(e))
+	if len(data) > max_size:
+		raise C4GroupError("Group is larger than {} bytes.".format(max_size))
+	return data
+
+def read_entries(data, offset=0):
+	"""Yields (filename, is_child_group, data) for the entries of the group starting at offset.
+	"""
+	if len(data) < offset + HEADER_FORMAT.size:
+		raise C4GroupError("Truncated group header.")
+	group_id, version1, version2, n_entries, _ = HEADER_FORMAT.unpack(unscramble(data[offset:offset + HEADER_FORMAT.size]))
+	if not group_id.startswith(GROUP_ID) or version1 != 1 or version2 > 2:
+		raise C4GroupError("Invalid group header.")
+
+	contents_offset = offset + HEADER_FORMAT.size + n_entries * ENTRY_FORMAT.size
+	if n_entries < 0 or len(data) < contents_offset:
+		raise C4GroupError("Truncated entry table.")
+	for i in range(n_entries):
+		entry_offset = offset + HEADER_FORMAT.size + i * ENTRY_FORMAT.size
+		fields = ENTRY_FORMAT.unpack(data[entry_offset:entry_offset + ENTRY_FORMAT.size])
+		filename = fields[0].split(b"\0", 1)[0].decode("utf-8", errors="replace")
+		is_child_group, size, data_offset = fields[2] != 0, fields[3], fields[5]
+		start = contents_offset + data_offset
+		if size < 0 or data_offset < 0 or start + size > len(data):
+			raise C4GroupError("Entry {} is out of bounds.".format(filename))
+		yield filename, is_child_group, data[start:start + size]
+
+def decode_text(data):
+	try:
+		return data.decode("utf-8-sig")
+	except UnicodeDecodeError:
+		return data.decode("cp1252", errors="replace")
+
+def parse_ini(data):
+	"""Parses OpenClonk's ini-like text files. Lines that can not be parsed are skipped.
+	"""
+	parser = configparser.ConfigParser(strict=False, interpolation=None, delimiters=("=",), comment_prefixes=("#", ";", "//"))
+	parser.optionxform = str
+	try:
+		parser.read_string(decode_text(data))
+	except configparser.Error:
+		pass
+	return parser
+
+def parse_title(data):
+	"""Returns the English title from a Title.txt with lines like "US:Title", or the first title otherwise.
+	"""
+	titles = dict()
+	for line in decode_text(data).splitlines():
+		language, separator, title = line.partition(":")
+		if separator and title.strip():
+			titles.setdefault(language.strip().upper(), title.strip())
+	return titles.get("US") or titles.get("EN") or next(iter(titles.values()), None)
+
+def parse_engine_version(version_string):
+	"""Converts e.g. "8,0" to "8.0". Returns None for versions that can not be parsed.
+	"""
+	if not version_string:
+		return None
+	parts = [part.strip() for part in version_string.split(",")]
+	# Real versions have a few digits per part; longer ones would not fit ResourceContent.engine_version.
+	if not parts[0].isdecimal() or len(parts[0]) > MAX_VERSION_DIGITS:
+		return None
+	return ".".join((part for part in parts[:2] if part.isdecimal() and len(part) <= MAX_VERSION_DIGITS))
+
+def get_group_kind(filename):
+	extension = filename[filename.rfind("."):].lower()
+	return dict(((".ocs", "scenario"), (".ocf", "folder"), (".ocd", "definition"))).get(extension)
+
+def read_group_contents(data, path, kind, contents, depth=0):
+	"""Appends a description of the group and, recursively, its child groups to contents.
+	"""
+	if depth > MAX_NESTING_DEPTH:
+		raise C4GroupError("Groups are nested too deeply.")
+	entries = dict()
+	child_groups = []
+	for (filename, is_child_group, entry_data) in read_entries(data):
+		if is_child_group or filename.lower().endswith(GROUP_EXTENSIONS):
+			child_groups.append((filename, entry_data))
+		else:
+			entries[filename.lower()] = entry_data
+
+	content = dict(path=path, kind=kind, identifier=None, title=None, engine_version=None)
+	if "title.txt" in entries:
+		content["title"] = parse_title(entries["title.txt"])
+	if "scenario.txt" in entries:
+		scenario = parse_ini(entries["scenario.txt"])
+		if scenario.has_section("Head"):
+			content["title"] = content["title"] or scenario["Head"].get("Title")
+			content["engine_version"] = parse_engine_version(scenario["Head"].get("Version"))
+	if "defcore.txt" in entries:
+		defcore = parse_ini(entries["defcore.txt"])
+		if defcore.has_section("DefCore"):
+			content["identifier"] = defcore["DefCore"].get("id")
+			content["engine_version"] = parse_engine_version(defcore["DefCore"].get("Version"))
+	if kind is not None:
+		contents.append(content)
+
+	for (filename, child_data) in child_groups:
+		try:
+			read_group_contents(child_data, path + "/" + filename, get_group_kind(filename), contents, depth + 1)
+		except C4GroupError:
+			# Entries with group extensions might be something else, e.g. uncompressed files.
+			continue
+
+def read_group_file_contents(path, filename, max_size=2**28):
+	"""Returns a list of dictionaries describing the scenarios, folders and definitions in the group file.
+	Raises C4GroupError if the file is not a valid group.
+	"""
+	contents = []
+	read_group_contents(decompress_group_file(path, max_size), filename, get_group_kind(filename), contents)
+	return contents
@@ -0,0 +1,184 @@
+import bisect
+import hmac
+import os
+import threading
+import time
+
+import flask
+import flask_caching.jinja2ext
+import sqlalchemy
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250)
+
+METRIC_DESCRIPTIONS = dict(
+	lorry_request_duration_seconds=("histogram", "Wall time of requests per endpoint."),
+	lorry_request_sql_queries=("histogram", "Number of SQL queries per request."),
+	lorry_request_sql_duration_seconds=("histogram", "Time spent executing SQL queries per request."),
+	lorry_cache_lookups_total=("counter", "Cache lookups, labeled by cache."),
+	lorry_cache_misses_total=("counter", "Cache lookups that had to compute the value, labeled by cache."),
+	lorry_download_bytes_total=("counter", "Bytes of files served by download_file."),
+	lorry_admission_rejections_total=("counter", "Requests rejected by admission control, labeled by endpoint class and reason."),
+)
+
+class Histogram():
+	__slots__ = ("buckets", "counts", "sum", "count")
+
+	def __init__(self, buckets):
+		self.buckets = buckets
+		# The last count is for values above the largest bucket.
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+class RequestMetrics():
+	"""Accumulates the SQL activity of the current request.
+	"""
+	__slots__ = ("start_time", "n_queries", "query_duration")
+
+	def __init__(self):
+		self.start_time = time.perf_counter()
+		self.n_queries = 0
+		self.query_duration = 0.0
+
+class MetricsRegistry():
+	"""Process-local metrics in the Prometheus text format.
+	Every gunicorn worker has its own registry, so all samples are labeled with the worker's process ID.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.histograms = dict()
+		self.counters = dict()
+
+	def observe(self, name, labels, value, buckets):
+		key = (name, labels)
+		with self.lock:
+			histogram = self.histograms.get(key)
+			if histogram is None:
+				histogram = self.histograms[key] = Histogram(buckets)
+			histogram.observe(value)
+
+	def increment(self, name, labels=(), value=1):
+		key = (name, labels)
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def count_cache_lookup(self, cache_name, count=1):
+		self.increment("lorry_cache_lookups_total", (("cache", cache_name),), count)
+
+	def count_cache_miss(self, cache_name, count=1):
+		self.increment("lorry_cache_misses_total", (("cache", cache_name),), count)
+
+	def render(self):
+		worker_label = ("worker", str(os.getpid()))
+		lines = []
+		with self.lock:
+			histograms = sorted(((key, h.buckets, list(h.counts), h.sum, h.count) for (key, h) in self.histograms.items()))
+			counters = sorted(self.counters.items())
+
+		def format_labels(labels):
+			return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for (k, v) in labels + (worker_label,)) + "}"
+
+		described_names = set()
+		def describe(name):
+			if name in described_names:
+				return
+			described_names.add(name)
+			metric_type, description = METRIC_DESCRIPTIONS[name]
+			lines.append("# HELP {} {}".format(name, description))
+			lines.append("# TYPE {} {}".format(name, metric_type))
+
+		for ((name, labels), buckets, counts, total, count) in histograms:
+			describe(name)
+			cumulative_count = 0
+			for (upper_bound, bucket_count) in zip(buckets, counts):
+				cumulative_count += bucket_count
+				lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", upper_bound),)), cumulative_count))
+			lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", "+Inf"),)), count))
+			lines.append("{}_sum{} {}".format(name, format_labels(labels), total))
+			lines.append("{}_count{} {}".format(name, format_labels(labels), count))
+
+		for ((name, labels), value) in counters:
+			describe(name)
+			lines.append("{}{} {}".format(name, format_labels(labels), value))
+
+		return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+class FragmentCacheMetrics():
+	"""Wraps the cache that is used by {% cache %} blocks in templates to count hits and misses.
+	"""
+	def __init__(self, cache):
+		self.cache = cache
+
+	def __getattr__(self, name):
+		return getattr(self.cache, name)
+
+	def get(self, key):
+		value = self.cache.get(key)
+		metrics.count_cache_lookup("template_fragment")
+		if value is None:
+			metrics.count_cache_miss("template_fragment")
+		return value
+
+def get_request_metrics():
+	if not flask.has_request_context():
+		return None
+	return flask.g.get("request_metrics")
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	conn.info["query_start_time"] = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	request_metrics = get_request_metrics()
+	if request_metrics is not None:
+		request_metrics.n_queries += 1
+		request_metrics.query_duration += time.perf_counter() - conn.info["query_start_time"]
+
+def start_request():
+	flask.g.request_metrics = RequestMetrics()
+
+def finish_request(exception):
+	request_metrics = flask.g.pop("request_metrics", None)
+	if request_metrics is None:
+		return
+	labels = (("endpoint", flask.request.endpoint or "none"),)
+	metrics.observe("lorry_request_duration_seconds", labels, time.perf_counter() - request_metrics.start_time, LATENCY_BUCKETS)
+	metrics.observe("lorry_request_sql_queries", labels, request_metrics.n_queries, QUERY_COUNT_BUCKETS)
+	metrics.observe("lorry_request_sql_duration_seconds", labels, request_metrics.query_duration, LATENCY_BUCKETS)
+
+def is_metrics_client():
+	"""Returns whether the current request sends "Authorization: Bearer <METRICS_TOKEN>".
+	The client address is not trusted, as requests forwarded by a local reverse proxy arrive from loopback.
+	"""
+	token = flask.current_app.config.get("METRICS_TOKEN")
+	if not token:
+		return False
+	return hmac.compare_digest(flask.request.headers.get("Authorization", ""), "Bearer " + token)
+
+def metrics_page():
+	if not is_metrics_client():
+		flask.abort(404)
+	return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+def init_app(app):
+	"""Records per-endpoint request metrics and serves them on /metrics.
+	Must be called after the cache was bound to the application.
+	"""
+	app.before_request(start_request)
+	app.teardown_request(finish_request)
+	if not sqlalchemy.event.contains(sqlalchemy.engine.Engine, "before_cursor_execute", before_cursor_execute):
+		sqlalchemy.event.listen(sqlalchemy.engine.Engine, "before_cursor_execute", before_cursor_execute)
+		sqlalchemy.event.listen(sqlalchemy.engine.Engine, "after_cursor_execute", after_cursor_execute)
+
+	fragment_cache = getattr(app.jinja_env, flask_caching.jinja2ext.JINJA_CACHE_ATTR_NAME, None)
+	if fragment_cache is not None:
+		setattr(app.jinja_env, flask_caching.jinja2ext.JINJA_CACHE_ATTR_NAME, FragmentCacheMetrics(fragment_cache))
+
+	app.add_url_rule("/metrics", "metrics", metrics_page)
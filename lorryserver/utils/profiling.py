@@ -0,0 +1,100 @@
+import collections
+import hmac
+import os
+import pathlib
+import random
+import sys
+import threading
+import time
+import uuid
+
+import flask
+import flask_login
+
+class StackSampler():
+	"""Periodically records the call stack of one thread from a background thread.
+	The result is in the folded format that flamegraph.pl and speedscope understand.
+	"""
+	def __init__(self, thread_id, interval):
+		self.thread_id = thread_id
+		self.interval = interval
+		self.stacks = collections.Counter()
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+
+	def start(self):
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+		self.thread.join()
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			frame = sys._current_frames().get(self.thread_id)
+			stack = []
+			while frame is not None:
+				code = frame.f_code
+				stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno).replace(";", ":"))
+				frame = frame.f_back
+			if stack:
+				self.stacks[";".join(reversed(stack))] += 1
+
+	def get_folded_stacks(self):
+		return "".join("{} {}\n".format(stack, count) for (stack, count) in self.stacks.items())
+
+def should_profile_request(config):
+	secret = config.get("PROFILING_SECRET")
+	if secret and hmac.compare_digest(flask.request.headers.get("X-Lorry-Profile", ""), secret):
+		return True
+	if "profile" in flask.request.args:
+		user = flask_login.current_user
+		if user.is_authenticated and user.is_moderator:
+			return True
+	return random.random() < config.get("PROFILING_SAMPLE_RATE")
+
+def start_request():
+	config = flask.current_app.config
+	if not should_profile_request(config):
+		return
+	sampler = StackSampler(threading.get_ident(), config.get("PROFILING_INTERVAL"))
+	sampler.start()
+	flask.g.profiling_sampler = sampler
+	flask.g.profiling_id = "{:013d}-{}".format(int(time.time() * 1000), uuid.uuid4().hex[:8])
+
+def add_profile_header(response):
+	if "profiling_id" in flask.g:
+		response.headers["X-Lorry-Profile-Id"] = flask.g.profiling_id
+	return response
+
+def finish_request(exception):
+	sampler = flask.g.pop("profiling_sampler", None)
+	if sampler is None:
+		return
+	sampler.stop()
+	config = flask.current_app.config
+	store_profile(pathlib.Path(config.get("PROFILING_PATH")), flask.request.endpoint or "none", flask.g.profiling_id,
+					sampler.get_folded_stacks(), config.get("PROFILING_MAX_PROFILES_PER_ENDPOINT"))
+
+def store_profile(base_path, endpoint, profile_id, folded_stacks, max_profiles):
+	"""Writes the profile to base_path/endpoint/ and removes the oldest profiles of the endpoint beyond max_profiles.
+	"""
+	directory = base_path / endpoint
+	directory.mkdir(parents=True, exist_ok=True)
+	(directory / "{}.folded".format(profile_id)).write_text(folded_stacks)
+
+	# The file names start with the time stamp.
+	profiles = sorted(directory.glob("*.folded"))
+	for outdated_profile in profiles[:-max_profiles]:
+		try:
+			outdated_profile.unlink()
+		except OSError:
+			pass
+
+def init_app(app):
+	"""Profiles requests that are selected by should_profile_request.
+	Nothing is registered if profiling is disabled, so it costs nothing then.
+	"""
+	app.before_request(start_request)
+	app.after_request(add_profile_header)
+	app.teardown_request(finish_request)
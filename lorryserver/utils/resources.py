@@ -1,10 +1,83 @@
+import gzip
 import hashlib
 import os
 import io
 import pathlib
 import shutil
 
-from .. import core
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+try:
+	import bsdiff4
+except ImportError:
+	bsdiff4 = None
+
+def compress_gzip(source, target):
+	with gzip.GzipFile(fileobj=target, mode="wb", compresslevel=9, mtime=0) as compressed:
+		shutil.copyfileobj(source, compressed, 2**16)
+
+def compress_zstd(source, target):
+	zstandard.ZstdCompressor(level=19).copy_stream(source, target)
+
+# Content-Encoding, file suffix and compression function of the precompressed variants, in order of preference.
+# Existing zstd variants are still served when zstandard is not installed, but no new ones are created.
+ENCODINGS = (
+	("zstd", ".zst", compress_zstd if zstandard is not None else None),
+	("gzip", ".gz", compress_gzip),
+)
+
+def create_compressed_variants(path, min_saving):
+	"""Creates the compressed variants of the file at path and keeps those that are at least min_saving (a fraction) smaller.
+	Returns the list of kept encodings. Runs in the job worker's process pool.
+	"""
+	path = pathlib.Path(path)
+	max_size = path.stat().st_size * (1.0 - min_saving)
+	kept_encodings = []
+	for (encoding, suffix, compress) in ENCODINGS:
+		variant_path = path.with_name(path.name + suffix)
+		if variant_path.exists():
+			kept_encodings.append(encoding)
+			continue
+		if compress is None:
+			continue
+		# Written to a temporary file first, so that downloads never see a partial variant.
+		# Its name is unique per process, as two workers might compress the same file at once.
+		temporary_path = path.with_name("{}{}.{}.tmp".format(path.name, suffix, os.getpid()))
+		with open(path, "rb") as source, open(temporary_path, "wb") as target:
+			compress(source, target)
+		if temporary_path.stat().st_size <= max_size:
+			os.replace(temporary_path, variant_path)
+			kept_encodings.append(encoding)
+		else:
+			os.remove(temporary_path)
+	return kept_encodings
+
+def get_temporary_delta_path(delta_path):
+	delta_path = pathlib.Path(delta_path)
+	delta_path.parent.mkdir(parents=True, exist_ok=True)
+	# Unique per process, as two workers might create the same delta at once.
+	return delta_path.with_name("{}.{}.tmp".format(delta_path.name, os.getpid()))
+
+def mark_delta_unavailable(delta_path):
+	"""Writes the empty marker file that tells clients to download the whole file, so that the delta is not generated again.
+	"""
+	temporary_path = get_temporary_delta_path(delta_path)
+	temporary_path.write_bytes(b"")
+	os.replace(temporary_path, delta_path)
+
+def create_delta(old_path, new_path, delta_path, max_ratio):
+	"""Writes a bsdiff patch from the old to the new file. Returns whether it was kept.
+	If the patch is not smaller than max_ratio times the new file, the delta is marked as unavailable instead.
+	"""
+	temporary_path = get_temporary_delta_path(delta_path)
+	bsdiff4.file_diff(str(old_path), str(new_path), str(temporary_path))
+	if temporary_path.stat().st_size > pathlib.Path(new_path).stat().st_size * max_ratio:
+		temporary_path.write_bytes(b"")
+	os.replace(temporary_path, delta_path)
+	return pathlib.Path(delta_path).stat().st_size > 0
 
 class ResourceManager():
 	def __init__(self, config):
@@ -54,6 +127,37 @@ class ResourceManager():
 		if path is not None:
 			shutil.move(source_path, path)
 
+	def get_delta_path(self, old_resource_name, new_resource_name):
+		"""Deltas are stored next to the old file, so that they are removed with it.
+		"""
+		old_path = self.get_resource_path(old_resource_name)
+		return old_path.with_name(old_path.name + ".delta") / "{}.bsdiff".format(new_resource_name)
+
+	def get_encoded_resource_path(self, resource_name, accept_encodings):
+		"""Returns the path of the best precompressed variant that the client accepts and its encoding.
+		Falls back to the raw file with an encoding of None.
+		"""
+		path = self.get_resource_path(resource_name)
+		candidates = sorted(((-accept_encodings[encoding], index, encoding, suffix)
+							for (index, (encoding, suffix, _)) in enumerate(ENCODINGS) if accept_encodings[encoding] > 0))
+		for (_, _, encoding, suffix) in candidates:
+			variant_path = path.with_name(path.name + suffix)
+			if variant_path.exists():
+				return variant_path, encoding
+		return path, None
+
+	def store_copy_from_filesystem(self, uuid, source_path):
+		"""Copies the file, unless a file with the same hash is already stored. Returns whether it was copied.
+		The file only appears once it is complete, so that an interrupted import can be repeated.
+		"""
+		path = self.ensure_resource_path_valid(uuid)
+		if path is None:
+			return False
+		temporary_path = path.with_name("{}.{}.tmp".format(path.name, os.getpid()))
+		shutil.copyfile(source_path, temporary_path)
+		os.replace(temporary_path, path)
+		return True
+
 	def get_resource(self, uuid):
 		path = self.get_resource_path(uuid)
 		with open(path, "rb") as f:
@@ -70,6 +174,13 @@ class ResourceManager():
 		except:
 			return
 
+		for (_, suffix, _) in ENCODINGS:
+			try:
+				os.remove(path.with_name(path.name + suffix))
+			except OSError:
+				pass
+		shutil.rmtree(path.with_name(path.name + ".delta"), ignore_errors=True)
+
 		try:
 			parent = self.get_parent_path(uuid)
 			# Note that rmdir only removes empty directories and raises an exception otherwise.
@@ -79,4 +190,5 @@ class ResourceManager():
 			return
 
 
-resource_manager = ResourceManager(core.create_flask_application().config)
+# Configured in core.create_flask_application.
+resource_manager = ResourceManager(None)
@@ -0,0 +1,4 @@
+from .core import create_flask_application
+
+# Entry point for WSGI servers, e.g. "gunicorn --preload lorryserver.wsgi:app".
+app = create_flask_application()
@@ -0,0 +1 @@
+python3 -c "from lorryserver.db.migrations import migrate;migrate()"
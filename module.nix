@@ -18,9 +18,16 @@ let
 
       CACHE_TYPE = "RedisCache"
       CACHE_REDIS_URL = "unix://${config.services.redis.servers.lorry.unixSocket}"
+      # Caddy forwards the client's address. The rate limits and concurrency caps are shared between the workers through Redis.
+      PROXY_FIX_X_FOR = 1
+      ADMISSION_CONTROL_ENABLED = True
+      ADMISSION_STORAGE = "cache"
       
       OWN_HOST = "${cfg.hostname}"
       RESOURCES_PATH = "${cfg.resourcesPath}"
+      # The worker renders the pages for anonymous visitors, which Caddy serves directly.
+      STATIC_PAGES_ENABLED = True
+      STATIC_PAGES_PATH = "${cfg.staticPagesPath}"
       ALLOWED_FILE_EXTENSIONS = ("ocs", "ocf", "ocd")
 
       ${lib.optionalString cfg.enablePostgres ''
@@ -60,6 +67,12 @@ in
       default = "/var/lib/lorry/resources";
     };
 
+    staticPagesPath = lib.mkOption {
+      type = lib.types.path;
+      description = "path the pre-rendered pages for anonymous visitors are stored at";
+      default = "/var/lib/lorry/static-pages";
+    };
+
     extraConfig = lib.mkOption {
       type = lib.types.str;
       description = "extra configuration (Python)";
@@ -94,6 +107,7 @@ in
 
     systemd.tmpfiles.rules = [
       "d ${cfg.resourcesPath} 0750 ${user} ${group} - -"
+      "d ${cfg.staticPagesPath} 0755 ${user} ${group} - -"
     ];
 
     systemd.services.lorry = {
@@ -101,13 +115,29 @@ in
       serviceConfig = {
         Type = "notify";
         NotifyAccess = "main";
-        ExecStart = "${pythonEnv}/bin/gunicorn --workers ${builtins.toString cfg.workerCount} -m 007 lorryserver.app:app";
+        # Preloading creates the application once before forking, so that workers start quickly and share its memory.
+        ExecStart = "${pythonEnv}/bin/gunicorn --preload --workers ${builtins.toString cfg.workerCount} -m 007 lorryserver.wsgi:app";
         User = user;
         PrivateTmp = true;
         ProtectSystem = "strict";
         ReadWritePaths = cfg.resourcesPath;
       };
     };
+    systemd.services.lorry-worker = {
+      description = "Lorry background job worker";
+      wantedBy = [ "multi-user.target" ];
+      after = [ "network.target" ] ++ lib.optional cfg.enablePostgres "postgresql.service";
+      serviceConfig = {
+        # Renders all static pages again, e.g. after the templates changed. Failures must not keep the worker from starting.
+        ExecStartPre = "-${pythonEnv}/bin/python3 -c \"from lorryserver.publisher import publish_all_static_pages;publish_all_static_pages()\"";
+        ExecStart = "${pythonEnv}/bin/python3 -m lorryserver.jobs";
+        User = user;
+        Restart = "always";
+        PrivateTmp = true;
+        ProtectSystem = "strict";
+        ReadWritePaths = [ cfg.resourcesPath cfg.staticPagesPath ];
+      };
+    };
     systemd.sockets.lorry = {
       description = "Lorry listen socket";
       wantedBy = [ "sockets.target" ];
@@ -120,8 +150,61 @@ in
     };
 
     services.caddy.enable = true;
+    # Anonymous GET requests for the package list and the details pages are served from the pre-rendered pages, if there are any.
+    # Everything else, including all requests with cookies, goes to the application.
     services.caddy.virtualHosts.${cfg.hostname}.extraConfig = ''
-      reverse_proxy unix/${cfg.socket}
+      @static_details {
+        not header Cookie *
+        method GET HEAD
+        path /uploads/*
+        expression {query} == ""
+        file {
+          root ${cfg.staticPagesPath}
+          try_files {path}.html
+        }
+      }
+      @static_index {
+        not header Cookie *
+        method GET HEAD
+        path /
+        expression {query} == ""
+        file {
+          root ${cfg.staticPagesPath}
+          try_files /index.html
+        }
+      }
+      @static_index_page {
+        not header Cookie *
+        method GET HEAD
+        path /
+        expression {query}.matches("^skip=[0-9]+&sort=-updatedAt&limit=50$")
+        file {
+          root ${cfg.staticPagesPath}
+          try_files /index-{query.skip}.html
+        }
+      }
+      handle @static_details {
+        root * ${cfg.staticPagesPath}
+        rewrite * {http.matchers.file.relative}
+        file_server
+      }
+      handle @static_index {
+        root * ${cfg.staticPagesPath}
+        rewrite * {http.matchers.file.relative}
+        file_server
+      }
+      handle @static_index_page {
+        root * ${cfg.staticPagesPath}
+        rewrite * {http.matchers.file.relative}
+        file_server
+      }
+      # The metrics are not public. Scrapers read them from the listen socket with METRICS_TOKEN.
+      handle /metrics {
+        respond 404
+      }
+      handle {
+        reverse_proxy unix/${cfg.socket}
+      }
     '';
 
     services.redis.servers.lorry = {
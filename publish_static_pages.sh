@@ -0,0 +1 @@
+python3 -c "from lorryserver.publisher import publish_all_static_pages;publish_all_static_pages()"
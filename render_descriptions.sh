@@ -0,0 +1,2 @@
+
+python3 -c "from lorryserver.db.render_descriptions import render_descriptions;render_descriptions()"
@@ -12,6 +12,7 @@ requires = [
 	"wtforms[email]",
 	"flask-WTF",
 	"Flask-Markdown",
+	"Markdown",
 	"Flask-Caching",
 	"is-safe-url",
 	"passlib",
@@ -32,5 +33,11 @@ setup(
         'lorryserver': ['static/*', 'templates/*'],
     },
     install_requires=requires,
+    extras_require={
+        # Enables zstd-compressed downloads.
+        "zstd": ["zstandard"],
+        # Enables binary deltas between releases.
+        "delta": ["bsdiff4"],
+    },
     package_dir={'lorryserver': 'lorryserver/'}
 )
@@ -1,4 +1,4 @@
-from lorryserver import app
+from lorryserver.wsgi import app
 
 if __name__ == "__main__":
     app.run()